@@ -1,12 +1,23 @@
 import network
 import urequests
 import time
+import random
 from machine import Pin
 
 WIFI_SSID = "Smth"
 WIFI_PASSWORD = "System222"
 
 BACKEND_URL = "http://10.17.33.88:8000/trigger" 
+BATCH_URL = BACKEND_URL + "/batch"
+
+# Batch mode: presses are queued and flushed to /trigger/batch, several per
+# request. A failed flush keeps them queued, so presses made during a Wi-Fi
+# drop are delivered together (in order, with their press times) once the
+# connection is back. Set to False to POST every press on its own.
+BATCH_MODE = True
+BATCH_SIZE = 20
+MAX_QUEUED = 200
+RETRY_MS = 2000
 
 DEVICE_ID = "esp32_hackathon_1"
 USER_ID = "default"
@@ -23,8 +34,15 @@ BUTTONS = {
 last_state = {b: 1 for b in BUTTONS}
 DEBOUNCE = 0.4
 
+# Sequence numbers restart at every boot; BOOT_ID tells the server which run they belong to.
+BOOT_ID = "%08x" % random.getrandbits(32)
+next_seq = 1
+pending = []
+last_attempt = None
+
+wlan = network.WLAN(network.STA_IF)
+
 def connect_wifi():
-    wlan = network.WLAN(network.STA_IF)
     wlan.active(True)
     wlan.connect(WIFI_SSID, WIFI_PASSWORD)
 
@@ -39,7 +57,8 @@ def send_event(button):
         "button": button,
         "language": "en",
         "device_id": DEVICE_ID,
-        "user_id": USER_ID
+        "user_id": USER_ID,
+        "async_audio": True
     }
 
     try:
@@ -49,6 +68,47 @@ def send_event(button):
     except Exception as e:
         print("SERVER ERROR:", e)
 
+def queue_press(button):
+    global next_seq
+    pending.append({"seq": next_seq, "button": button, "ticks": time.ticks_ms()})
+    next_seq += 1
+    if len(pending) > MAX_QUEUED:
+        dropped = pending.pop(0)
+        print("QUEUE FULL, dropped", dropped["button"])
+
+def flush_presses():
+    global last_attempt
+    if not pending or not wlan.isconnected():
+        return
+    last_attempt = time.ticks_ms()
+    batch = pending[:BATCH_SIZE]
+    payload = {
+        "device_id": DEVICE_ID,
+        "user_id": USER_ID,
+        "boot_id": BOOT_ID,
+        "presses": [
+            {"seq": p["seq"], "button": p["button"], "language": "en",
+             "age_ms": time.ticks_diff(last_attempt, p["ticks"])}
+            for p in batch
+        ],
+    }
+
+    try:
+        r = urequests.post(BATCH_URL, json=payload)
+        status = r.status_code
+        r.close()
+    except Exception as e:
+        print("SERVER ERROR:", e)
+        return
+    print("Flushed", len(batch), "→", status)
+    if status == 200:
+        # Duplicates are acknowledged too, so the whole batch is done.
+        del pending[:len(batch)]
+        last_attempt = None
+
+def flush_due():
+    return last_attempt is None or time.ticks_diff(time.ticks_ms(), last_attempt) >= RETRY_MS
+
 connect_wifi()
 print("\nDEVICE READY\n")
 
@@ -58,9 +118,17 @@ while True:
 
         if val == 0 and last_state[name] == 1:
             print("BUTTON PRESSED:", name)
-            send_event(name)
+            if BATCH_MODE:
+                queue_press(name)
+                # A new press is sent straight away; only retries wait for RETRY_MS.
+                last_attempt = None
+            else:
+                send_event(name)
             time.sleep(DEBOUNCE)
 
         last_state[name] = val
 
+    if BATCH_MODE and flush_due():
+        flush_presses()
+
     time.sleep(0.05)
\ No newline at end of file
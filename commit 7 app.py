@@ -1,14 +1,18 @@
 import streamlit as st
 import streamlit.components.v1 as components
 from shared import (
-    CONFIG, HISTORY, trigger, user_signup, user_login, register_device,
-    get_user_devices, add_caretaker, get_accessible_accounts, _load_users,
+    trigger, user_signup, user_login, register_device,
+    get_user_devices, add_caretaker, get_accessible_accounts, get_user_by_email,
     set_user_theme, get_user_profile, verify_security_answer, reset_password,
-    SECURITY_QUESTIONS, get_user_medicines, set_user_medicines
+    SECURITY_QUESTIONS, get_user_medicines, set_user_medicines,
+    audio_mime, help_phrase, medicine_phrase, update_config, config_snapshot
 )
-from shared import _load_events
+from shared import iter_events
 import collections
 import datetime
+import json
+import os
+from urllib.parse import urlencode
 try:
     import pandas as pd
 except Exception:       
@@ -20,6 +24,9 @@ except Exception:
 
 st.set_page_config(page_title="Assistive Buttons", layout="wide", initial_sidebar_state="collapsed")
 
+# FastAPI server (server.py) that publishes live presses; the browser connects to it directly.
+SERVER_URL = os.environ.get("ASSISTIVE_SERVER_URL", "http://localhost:8000")
+
 def init_session_state():
     if "logged_in" not in st.session_state:
         st.session_state.logged_in = False
@@ -69,6 +76,48 @@ a { color: #667eea !important; }
 
 st.markdown(f"<style>{theme_css}</style>", unsafe_allow_html=True)
 
+LIVE_FEED_HTML = """
+<div id="feed" style="font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', sans-serif; color: #ffffff;">
+  <div id="status" style="color: #a0aec0; font-size: 13px; margin-bottom: 8px;">Connecting...</div>
+  <div id="items"></div>
+</div>
+<script>
+const items = document.getElementById("items");
+const status = document.getElementById("status");
+const source = new EventSource(__STREAM_URL__);
+source.onopen = () => { status.textContent = "Live"; };
+source.onerror = () => { status.textContent = "Reconnecting..."; };
+source.addEventListener("press", (msg) => {
+  const evt = JSON.parse(msg.data);
+  const row = document.createElement("div");
+  row.style.cssText = "background: #1a1f3a; border: 1px solid #2d3d5f; border-radius: 8px; padding: 8px 12px; margin-bottom: 6px;";
+  const when = new Date(evt.timestamp).toLocaleTimeString();
+  row.textContent = `${when}  ${evt.button}  ${evt.text}  (${evt.user_id}, ${evt.source})`;
+  items.prepend(row);
+  while (items.children.length > __MAX_ITEMS__) { items.removeChild(items.lastChild); }
+});
+</script>
+"""
+
+
+def show_live_feed(max_items: int = 20):
+    """Presses for this account and the accounts it looks after, pushed from the server.
+
+    The feed lives in its own iframe and updates from the server's event
+    stream, so new presses appear without rerunning the Streamlit script.
+    """
+    stream_url = f"{SERVER_URL}/events/stream?" + urlencode({"caretaker": st.session_state.email})
+    html = LIVE_FEED_HTML.replace("__STREAM_URL__", json.dumps(stream_url)).replace("__MAX_ITEMS__", str(max_items))
+    components.html(html, height=260, scrolling=True)
+
+CONFIG_WIDGET_KEYS = [f"{prefix}_edit_BTN{i}" for i in range(1, 7) for prefix in ["label", "en", "hi", "it"]]
+
+def save_config_edit(btn_key, widget_key, language=None):
+    """Save one edited label or text as an override for the logged-in user."""
+    value = st.session_state[widget_key]
+    change = {"texts": {language: value}} if language else {"label": value}
+    update_config({btn_key: change}, user_id=st.session_state.user_id)
+
 def logout():
     st.session_state.logged_in = False
     st.session_state.user_id = None
@@ -134,14 +183,9 @@ def show_auth_page():
             st.markdown('<h3 style="margin-bottom: 24px;">Reset your password</h3>', unsafe_allow_html=True)
             reset_email = st.text_input("Email address", placeholder="your@email.com", key="reset_email")
             if st.button("Find Account", use_container_width=True, key="find_account_btn"):
-                users_db = _load_users()
-                found_user = None
-                for uid, user in users_db.items():
-                    if user["email"] == reset_email:
-                        found_user = (uid, user)
-                        break
+                found_user = get_user_by_email(reset_email) if reset_email else None
                 if found_user:
-                    st.info(f"Security Question: {found_user[1].get('security_question', '')}")
+                    st.info(f"Security Question: {found_user.get('security_question', '')}")
                 else:
                     st.error("Email not found")
         
@@ -165,11 +209,20 @@ def show_main_app():
             logout()
 
     if page == "home":
-        components.html("""<script>setTimeout(()=>{ window.location.reload(); }, 2000);</script>""", height=0)
+        # This user's buttons; the store reloads edits made elsewhere, so no restart is needed.
+        config_version, _, config = config_snapshot(st.session_state.user_id)
+        if st.session_state.get("config_version") != config_version:
+            # Drop the edit widgets' state so they show the current texts.
+            for widget_key in CONFIG_WIDGET_KEYS:
+                st.session_state.pop(widget_key, None)
+            st.session_state.config_version = config_version
         
         st.markdown('<h1 style="text-align: center;">Assistive Buttons</h1>', unsafe_allow_html=True)
         st.markdown('<p style="text-align: center; color: #a0aec0;">Simple, accessible communication for everyone</p>', unsafe_allow_html=True)
         
+        with st.expander("Live Activity", expanded=True):
+            show_live_feed()
+        
         col_lang = st.columns([1])[0]
         with col_lang:
             lang = st.selectbox("Language", options=["en", "hi", "it", "de", "fr", "es"], 
@@ -184,7 +237,7 @@ def show_main_app():
             with c1:
                 if st.button("Send Help Request", use_container_width=True, key="help_submit_btn"):
                     if help_text.strip():
-                        evt = trigger("BTN1", lang, source="UI", custom_text=f"Help needed: {help_text}",
+                        evt = trigger("BTN1", lang, source="UI", custom_text=help_phrase(help_text),
                             device_id=st.session_state.device_id, user_id=st.session_state.user_id)
                         st.session_state.show_help_modal = False
                         st.session_state.help_request_text = ""
@@ -208,7 +261,7 @@ def show_main_app():
                 with cols[idx % 3]:
                     if st.button(f"{medicine['icon']}\n{medicine['name']}\n{medicine['dosage']}", 
                         key=f"med_{idx}", use_container_width=True):
-                        medicine_text = f"Give me {medicine['name']} ({medicine['dosage']})"
+                        medicine_text = medicine_phrase(medicine)
                         evt = trigger("BTN2", lang, source="UI", custom_text=medicine_text,
                             device_id=st.session_state.device_id, user_id=st.session_state.user_id)
                         st.session_state.show_medicine_modal = False
@@ -240,7 +293,7 @@ def show_main_app():
         
         for i, btn_key in enumerate(["BTN1", "BTN2", "BTN3", "BTN4", "BTN5", "BTN6"]):
             with grid_cols[i % 2]:
-                btn_label = CONFIG[btn_key]["label"]
+                btn_label = config[btn_key]["label"]
                 btn_icon = button_configs[btn_key]["icon"]
                 btn_color = button_configs[btn_key]["color"]
                 
@@ -259,7 +312,7 @@ def show_main_app():
                         st.rerun()
                     else:
                         lang = st.session_state.get("home_lang", "en")
-                        custom_text = CONFIG[btn_key]["texts"].get(lang, CONFIG[btn_key]["texts"]["en"])
+                        custom_text = config[btn_key]["texts"].get(lang, config[btn_key]["texts"]["en"])
 
                         with st.spinner("Speaking..."):
                             evt = trigger(
@@ -273,13 +326,9 @@ def show_main_app():
 
                             audio_bytes = evt.get("audio")
                             if audio_bytes:
-                                import base64
-                                audio_b64 = base64.b64encode(audio_bytes).decode("utf-8")
-                                components.html(f"""
-                                    <audio autoplay>
-                                        <source src="data:audio/mp3;base64,{audio_b64}" type="audio/mpeg">
-                                    </audio>
-                                """, height=0)
+                                # st.audio serves the raw bytes from Streamlit's media endpoint,
+                                # so no base64 data: URI copy is built.
+                                st.audio(bytes(audio_bytes), format=audio_mime(audio_bytes), autoplay=True)
 
                             spoken_text = evt.get("text", "Unknown")
                             st.success(f"Spoken: **{spoken_text}**")
@@ -288,22 +337,24 @@ def show_main_app():
         with st.expander("Customize Buttons", expanded=False):
             edit_tabs = st.tabs(["Labels", "Languages", "Test Audio", "Medicines"])
             
+            # Edits are saved as this account's overrides as soon as a field changes.
             with edit_tabs[0]:
                 st.markdown('**Update button labels:**')
                 for btn_key in ["BTN1", "BTN2", "BTN3", "BTN4", "BTN5", "BTN6"]:
-                    CONFIG[btn_key]["label"] = st.text_input(f"{btn_key} Label", CONFIG[btn_key]["label"], key=f"label_edit_{btn_key}")
+                    st.text_input(f"{btn_key} Label", config[btn_key]["label"], key=f"label_edit_{btn_key}",
+                        on_change=save_config_edit, args=(btn_key, f"label_edit_{btn_key}"))
             
             with edit_tabs[1]:
                 st.markdown('**Update text for languages:**')
                 for btn_key in ["BTN1", "BTN2", "BTN3", "BTN4", "BTN5", "BTN6"]:
-                    st.markdown(f"**{btn_key}: {CONFIG[btn_key]['label']}**")
-                    c1, c2, c3 = st.columns(3)
-                    with c1:
-                        CONFIG[btn_key]["texts"]["en"] = st.text_input(f"{btn_key} EN", CONFIG[btn_key]["texts"]["en"], key=f"en_edit_{btn_key}")
-                    with c2:
-                        CONFIG[btn_key]["texts"]["hi"] = st.text_input(f"{btn_key} HI", CONFIG[btn_key]["texts"]["hi"], key=f"hi_edit_{btn_key}")
-                    with c3:
-                        CONFIG[btn_key]["texts"]["it"] = st.text_input(f"{btn_key} IT", CONFIG[btn_key]["texts"]["it"], key=f"it_edit_{btn_key}")
+                    st.markdown(f"**{btn_key}: {config[btn_key]['label']}**")
+                    for col, code in zip(st.columns(3), ["en", "hi", "it"]):
+                        with col:
+                            st.text_input(f"{btn_key} {code.upper()}", config[btn_key]["texts"][code], key=f"{code}_edit_{btn_key}",
+                                on_change=save_config_edit, args=(btn_key, f"{code}_edit_{btn_key}", code))
+                if st.button("Reset to Defaults", use_container_width=True, key="config_reset_btn"):
+                    update_config({btn_key: None for btn_key in config}, user_id=st.session_state.user_id)
+                    st.rerun()
             
             with edit_tabs[2]:
                 test_lang = st.selectbox("Select Language", ["en", "hi", "it", "de", "fr", "es"], key="test_tts_lang")
@@ -312,7 +363,7 @@ def show_main_app():
                     if test_text:
                         from shared import speak_text
                         speak_text(test_text, test_lang)
-                        st.success("Audio played!")
+                        st.success("Audio queued for playback!")
                     else:
                         st.error("Please enter text")
             
@@ -364,23 +415,21 @@ def show_main_app():
 
     elif page == "logistics":
         st.markdown('<h2>Logistics</h2>', unsafe_allow_html=True)
-        events = _load_events() or HISTORY
-        if not events:
+        rows = []
+        for e in iter_events():
+            ts = e.get('timestamp')
+            try:
+                dt = datetime.datetime.fromisoformat(ts)
+            except Exception:
+                dt = None
+            rows.append({
+                'timestamp': ts, 'dt': dt, 'date': dt.date() if dt else None,
+                'button': e.get('button'), 'device_id': e.get('device_id') or 'unknown',
+                'text': e.get('text')
+            })
+        if not rows:
             st.info("No events recorded yet.")
         else:
-            rows = []
-            for e in events:
-                ts = e.get('timestamp')
-                try:
-                    dt = datetime.datetime.fromisoformat(ts)
-                except Exception:
-                    dt = None
-                rows.append({
-                    'timestamp': ts, 'dt': dt, 'date': dt.date() if dt else None,
-                    'button': e.get('button'), 'device_id': e.get('device_id') or 'unknown',
-                    'text': e.get('text')
-                })
-            
             df = pd.DataFrame(rows) if pd else None
             min_date = min([r['date'] for r in rows if r['date']]) if any(r['date'] for r in rows) else None
             max_date = max([r['date'] for r in rows if r['date']]) if any(r['date'] for r in rows) else None
@@ -413,20 +462,18 @@ def show_main_app():
 
     elif page == "analytics":
         st.markdown('<h2>Analytics</h2>', unsafe_allow_html=True)
-        events = _load_events() or HISTORY
-        if not events:
+        rows = []
+        for e in iter_events():
+            ts = e.get('timestamp')
+            try:
+                dt = datetime.datetime.fromisoformat(ts)
+            except Exception:
+                dt = None
+            rows.append({'timestamp': ts, 'dt': dt, 'date': dt.date() if dt else None, 'hour': dt.hour if dt else None,
+                         'button': e.get('button'), 'device_id': e.get('device_id') or 'unknown', 'language': e.get('language')})
+        if not rows:
             st.info("No events to analyze yet.")
         else:
-            rows = []
-            for e in events:
-                ts = e.get('timestamp')
-                try:
-                    dt = datetime.datetime.fromisoformat(ts)
-                except Exception:
-                    dt = None
-                rows.append({'timestamp': ts, 'dt': dt, 'date': dt.date() if dt else None, 'hour': dt.hour if dt else None,
-                             'button': e.get('button'), 'device_id': e.get('device_id') or 'unknown', 'language': e.get('language')})
-            
             df = pd.DataFrame(rows) if pd else None
             
             buttons = sorted(list({r['button'] for r in rows if r['button']}))
@@ -1,12 +1,26 @@
 # server.py
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
-from shared import trigger, CONFIG, HISTORY, user_login, register_device
+from typing import Optional, Dict, Any, List
+from shared import HISTORY, user_login, register_device, user_cache_stats
+from shared import audio_cache_stats, warm_audio_cache, warmup_status, tts_stats, event_audio
+from shared import get_audio_variant, audio_mime, AUDIO_FORMATS, load_audio_bundle, playback_stats
+from shared import build_event, submit_events, event_audio_now, event_audio_later, event_result
+from shared import ensure_device, event_writer_stats, prepare_batch, release_batch, BATCH_MAX_PRESSES
+from shared import event_log_position, read_events_since, get_accessible_accounts, query_events
+from shared import config_snapshot, config_delta, watch_config
 
-import base64
-from fastapi.responses import JSONResponse
+import asyncio
+import concurrent.futures
+import hashlib
+import collections
+import json
+import os
+import threading
+import time
+from urllib.parse import urlencode
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 
 app = FastAPI(title="Assistive Buttons Server")
@@ -26,51 +40,471 @@ class TriggerRequest(BaseModel):
     device_id: str = "unknown"  
     user_id: str = "default"
     device_name: str = None  
+    async_audio: bool = False
+    audio_format: Optional[str] = None  # mp3, opus or pcm8k
+    audio_bitrate: Optional[str] = None  # e.g. "16k"
+
+class BatchPress(BaseModel):
+    seq: int  # per-boot press counter on the device, starting at 1
+    button: Optional[str] = None  # checked per press, so one bad press does not reject the batch
+    language: str = "en"
+    custom_text: str = None
+    timestamp: Optional[str] = None  # ISO time, if the device has a clock
+    age_ms: Optional[int] = None  # else: milliseconds between the press and sending the batch
+
+class TriggerBatchRequest(BaseModel):
+    device_id: str = "unknown"
+    user_id: str = "default"
+    device_name: str = None
+    boot_id: str = ""
+    presses: List[BatchPress]
+
+# Blocking work behind /trigger runs in small fixed pools; each stage also caps
+# how many calls may be waiting, so overload is answered with 503 instead of
+# an ever-growing backlog.
+TRIGGER_IO_WORKERS = int(os.environ.get("TRIGGER_IO_WORKERS", "4"))
+TRIGGER_AUDIO_WORKERS = int(os.environ.get("TRIGGER_AUDIO_WORKERS", "8"))
+TRIGGER_MAX_PENDING = int(os.environ.get("TRIGGER_MAX_PENDING", "1000"))
+
+
+class Overloaded(Exception):
+    """A trigger stage is at its pending limit."""
+
+
+class _Stage:
+    """Bounded executor for one blocking stage of the trigger pipeline."""
+
+    def __init__(self, name: str, workers: int, max_pending: int = TRIGGER_MAX_PENDING):
+        self.max_pending = max_pending
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        # Only touched from the event loop thread, so no lock is needed.
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise Overloaded()
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def stats(self) -> dict:
+        return {"pending": self.pending, "completed": self.completed, "rejected": self.rejected}
+
+
+_IO_STAGE = _Stage("trigger-io", TRIGGER_IO_WORKERS)
+_AUDIO_STAGE = _Stage("trigger-audio", TRIGGER_AUDIO_WORKERS)
+
+
+def _overloaded_response():
+    return JSONResponse({"ok": False, "error": "server busy"}, status_code=503,
+                        headers={"Retry-After": "1"})
+
+
+STREAM_QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE_SIZE", "256"))
+STREAM_HEARTBEAT = float(os.environ.get("STREAM_HEARTBEAT", "15"))
+STREAM_POLL_INTERVAL = float(os.environ.get("STREAM_POLL_INTERVAL", "0.25"))
+STREAM_REPLAY = int(os.environ.get("STREAM_REPLAY", "1000"))
+
+
+class _Stream:
+    def __init__(self, users: Optional[set]):
+        self.users = users
+        self.queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    def wants(self, event: dict) -> bool:
+        return self.users is None or event.get("user_id") in self.users
+
+
+class _EventHub:
+    """Fans newly stored events out to open /events/stream connections.
+
+    One thread follows the shared event store, so presses stored by any
+    process (this server or the Streamlit app) are published, and hops each
+    event onto the event loop. Every connection has its own bounded queue,
+    so a slow client loses events instead of holding up the others.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._streams = set()
+        self.recent = collections.deque(maxlen=STREAM_REPLAY)
+        self.published = 0
+        self.dropped = 0
+
+    def start(self, loop):
+        self._loop = loop
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._follow, name="event-stream", daemon=True)
+            self._thread.start()
+
+    def _follow(self):
+        position = event_log_position()
+        while True:
+            time.sleep(STREAM_POLL_INTERVAL)
+            try:
+                events, position = read_events_since(position)
+            except Exception as e:
+                print(f"Event stream error: {e}")
+                continue
+            for event in events:
+                self._loop.call_soon_threadsafe(self._publish, event)
+
+    def _publish(self, event: dict):
+        self.published += 1
+        self.recent.append(event)
+        for stream in self._streams:
+            if stream.wants(event):
+                try:
+                    stream.queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    self.dropped += 1
+
+    def open(self, users: Optional[set]) -> _Stream:
+        stream = _Stream(users)
+        self._streams.add(stream)
+        return stream
+
+    def close(self, stream: _Stream):
+        self._streams.discard(stream)
+
+    def stats(self) -> dict:
+        return {"streams": len(self._streams), "published": self.published, "dropped": self.dropped}
+
+
+_EVENT_HUB = _EventHub()
+
+
+@app.on_event("startup")
+async def start_event_hub():
+    _EVENT_HUB.start(asyncio.get_running_loop())
+
+@app.on_event("startup")
+def warm_up_audio():
+    # Bundled clips are served straight from the mmap, so warm-up finds them cached.
+    load_audio_bundle()
+    warm_audio_cache()
+    # Config edits saved by the Streamlit app reach this process without a restart.
+    watch_config()
 
 @app.get("/health")
 def health():
-    return {"ok": True}
+    return {"ok": True, "user_cache": user_cache_stats(), "history": HISTORY.stats(),
+            "audio_cache": audio_cache_stats(), "warmup": warmup_status(),
+            "tts": tts_stats(), "playback": playback_stats(),
+            "trigger": {"io": _IO_STAGE.stats(), "audio": _AUDIO_STAGE.stats(),
+                        "writer": event_writer_stats()},
+            "stream": _EVENT_HUB.stats()}
+
+def _trigger_response(req: TriggerRequest, evt: dict) -> dict:
+    # Audio is never inlined; clients fetch the raw MP3 from audio_url.
+    if evt["audio_status"] == "ready":
+        audio_url = f"/audio/clip/{evt['audio_id']}"
+    elif evt["audio_status"] == "pending":
+        audio_url = f"/audio/{evt['event_id']}"
+    else:
+        audio_url = None
+    if audio_url and req.audio_format:
+        query = {"format": req.audio_format}
+        if req.audio_bitrate:
+            query["bitrate"] = req.audio_bitrate
+        audio_url += "?" + urlencode(query)
+    
+    return {
+        "ok": True,
+        "event_id": evt["event_id"],
+        "audio_id": evt["audio_id"],
+        "audio_status": evt["audio_status"],
+        "audio_url": audio_url,
+        "event": {k: v for k, v in evt.items() if k != "audio"},
+    }
+
 
 @app.post("/trigger")
-def trigger_endpoint(req: TriggerRequest):
+async def trigger_endpoint(req: TriggerRequest):
+    """Validate, persist, synthesize and notify without blocking the event loop."""
+    try:
+        if req.device_name and req.user_id != "default":
+            try:
+                await _IO_STAGE.run(ensure_device, req.user_id, req.device_id, req.device_name)
+            except Overloaded:
+                raise
+            except Exception:
+                pass
+        
+        # Resolving the text reads the config, which may reload it from storage.
+        event = await _IO_STAGE.run(build_event, req.button, req.language, "DEVICE", req.custom_text,
+                                    req.device_id, req.user_id)
+        # Persist: the group-commit writer resolves the future once the event is stored.
+        written = submit_events([event])
+        if written is None:
+            raise Overloaded()
+        await asyncio.wrap_future(written)
+    except Overloaded:
+        return _overloaded_response()
     
-    if req.device_name and req.user_id != "default":
-        try:
-            register_device(req.user_id, req.device_id, req.device_name)
-        except Exception:
-            pass
+    # The press is stored now, so a busy server answers without audio rather
+    # than with a 503 that would make the client send it again.
+    try:
+        if req.async_audio:
+            audio_bytes, audio_status = await _IO_STAGE.run(event_audio_later, event)
+        else:
+            audio_bytes, audio_status = await _AUDIO_STAGE.run(event_audio_now, event)
+    except Overloaded:
+        audio_bytes, audio_status = None, "failed"
     
-    evt = trigger(
-        button=req.button,
-        language=req.language,
-        source="DEVICE",
-        custom_text=req.custom_text,
-        device_id=req.device_id,
-        user_id=req.user_id
+    return _trigger_response(req, event_result(event, audio_bytes, audio_status))
+
+
+def _batch_audio_later(events: list):
+    for event in events:
+        event_audio_later(event)
+
+
+def _prepare_and_submit_batch(presses: list, device_id: str, user_id: str, boot_id: str):
+    # One job, so a cancelled request cannot leave seqs claimed but never submitted.
+    events, results, claim = prepare_batch(presses, device_id, user_id, boot_id)
+    written = None
+    if events:
+        written = submit_events(events)
+        if written is None:
+            release_batch(claim)
+            raise Overloaded()
+    return events, results, claim, written
+
+
+@app.post("/trigger/batch")
+async def trigger_batch_endpoint(req: TriggerBatchRequest):
+    """Store a device's buffered presses in one write and report a result per press.
+
+    Presses whose seq was already stored for this device and boot_id are
+    acknowledged as duplicates, so a device can safely re-send a batch, even
+    after a server restart. A seq below 1 is reported as invalid.
+    """
+    if len(req.presses) > BATCH_MAX_PRESSES:
+        return JSONResponse({"ok": False, "error": f"at most {BATCH_MAX_PRESSES} presses per batch"},
+                            status_code=413)
+    try:
+        if req.device_name and req.user_id != "default":
+            try:
+                await _IO_STAGE.run(ensure_device, req.user_id, req.device_id, req.device_name)
+            except Overloaded:
+                raise
+            except Exception:
+                pass
         
-        )
+        events, results, claim, written = await _IO_STAGE.run(
+            _prepare_and_submit_batch, [press.dict() for press in req.presses],
+            req.device_id, req.user_id, req.boot_id)
+        if events:
+            try:
+                await asyncio.wrap_future(written)
+            except Exception as e:
+                release_batch(claim)
+                return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+            # Late presses still get audio so the dashboard can play them back;
+            # they are already stored, so a busy server only skips this step.
+            try:
+                await _IO_STAGE.run(_batch_audio_later, events)
+            except Overloaded:
+                pass
+    except Overloaded:
+        return _overloaded_response()
     
-    audio_bytes = evt.get("audio")
+    return {"ok": True, "stored": len(events), "results": results}
 
-    audio_b64 = None
-    if audio_bytes:
-        audio_b64 = base64.b64encode(audio_bytes).decode("utf-8")
 
-    
-    return {
-        "ok": True,
-        "event": evt,
-        "audio_base64": audio_b64
-    }
+# Accept media types mapped to delivery formats.
+_ACCEPT_FORMATS = {"audio/ogg": "opus", "audio/opus": "opus", "audio/wav": "pcm8k",
+                   "audio/l16": "pcm8k", "audio/mpeg": "mp3"}
+
+
+def _negotiate_format(request: Request, fmt: Optional[str]) -> Optional[str]:
+    """Delivery format from ?format=, else the best-q known type in Accept."""
+    if fmt:
+        return fmt if fmt in AUDIO_FORMATS else None
+    best, best_q = None, 0.0
+    for item in request.headers.get("accept", "").split(","):
+        media, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        chosen = _ACCEPT_FORMATS.get(media.strip().lower())
+        if chosen and q > best_q:
+            best, best_q = chosen, q
+    return best
+
+
+def _audio_response(request: Request, audio_bytes: bytes):
+    """Raw audio response with ETag, conditional GET and single-range support."""
+    etag = '"%s"' % hashlib.blake2b(audio_bytes, digest_size=16).hexdigest()
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "public, max-age=3600",
+               "Vary": "Accept"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    total = len(audio_bytes)
+    range_header = request.headers.get("range")
+    if range_header and range_header.startswith("bytes=") and "," not in range_header:
+        start_s, _, end_s = range_header[6:].partition("-")
+        try:
+            if start_s:
+                start = int(start_s)
+                end = min(int(end_s), total - 1) if end_s else total - 1
+            else:
+                start = max(total - int(end_s), 0)
+                end = total - 1
+        except ValueError:
+            start, end = 0, -1
+        if start > end or start >= total:
+            headers["Content-Range"] = f"bytes */{total}"
+            return Response(status_code=416, headers=headers)
+        headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+        return Response(content=audio_bytes[start:end + 1], status_code=206,
+                        media_type=audio_mime(audio_bytes), headers=headers)
+
+    return Response(content=audio_bytes, media_type=audio_mime(audio_bytes), headers=headers)
+
+
+@app.get("/audio/clip/{audio_id}")
+def get_audio_clip(audio_id: str, request: Request, format: Optional[str] = None,
+                   bitrate: Optional[str] = None):
+    """Cached clip by audio id (as returned by /trigger), in the negotiated format."""
+    audio_bytes = get_audio_variant(audio_id, _negotiate_format(request, format), bitrate)
+    if audio_bytes is None:
+        return JSONResponse({"ok": False, "status": "unknown"}, status_code=404)
+    return _audio_response(request, audio_bytes)
+
+
+@app.get("/audio/{event_id}")
+def get_event_audio(event_id: str, request: Request, format: Optional[str] = None,
+                    bitrate: Optional[str] = None):
+    """Audio for an event; 202 while it is still being synthesized."""
+    status, audio_id = event_audio(event_id)
+    if status == "ready":
+        audio_bytes = get_audio_variant(audio_id, _negotiate_format(request, format), bitrate)
+        if audio_bytes is not None:
+            return _audio_response(request, audio_bytes)
+        status = "unknown"
+    if status == "pending":
+        return JSONResponse({"ok": False, "status": status}, status_code=202)
+    return JSONResponse({"ok": False, "status": status}, status_code=404)
+
+
+def _stream_message(event: dict) -> str:
+    data = {k: v for k, v in event.items() if k != "audio"}
+    data["audio_url"] = f"/audio/{event['event_id']}"
+    return f"id: {event['event_id']}\nevent: press\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _missed_events(users: Optional[set], last_event_id: str) -> list:
+    """Events published after last_event_id, for a client that reconnects."""
+    recent = [e for e in _EVENT_HUB.recent if users is None or e.get("user_id") in users]
+    for i, event in enumerate(recent):
+        if event.get("event_id") == last_event_id:
+            return recent[i + 1:]
+    return []
+
+
+@app.get("/events/stream")
+async def event_stream(request: Request, user_id: Optional[str] = None, caretaker: Optional[str] = None):
+    """Server-Sent Events feed of new presses.
+
+    user_id limits the feed to one user; caretaker to the accounts that
+    caretaker can access (and their own). Browsers resume after a drop with
+    Last-Event-ID and receive the presses they missed.
+    """
+    users = None
+    if caretaker:
+        try:
+            accounts = await _IO_STAGE.run(get_accessible_accounts, caretaker)
+        except Overloaded:
+            return _overloaded_response()
+        users = {account["email"].lower() for account in accounts} | {caretaker.lower()}
+    if user_id:
+        users = {user_id} if users is None else users & {user_id}
+    last_event_id = request.headers.get("last-event-id")
+    stream = _EVENT_HUB.open(users)
+
+    async def messages():
+        try:
+            yield "retry: 3000\n\n"
+            # The stream is already open, so a replayed event may also be queued.
+            replayed = set()
+            if last_event_id:
+                for event in _missed_events(users, last_event_id):
+                    replayed.add(event["event_id"])
+                    yield _stream_message(event)
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(stream.queue.get(), STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event["event_id"] not in replayed:
+                    yield _stream_message(event)
+        finally:
+            _EVENT_HUB.close(stream)
+
+    return StreamingResponse(messages(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]
 
 
 @app.get("/config")
-def get_config():
-    return CONFIG
+def get_config(request: Request, since: Optional[int] = None, user_id: Optional[str] = None):
+    """Button config (with the user's overrides if user_id is given), with ETag/If-None-Match.
+
+    With ?since=<version> (from the X-Config-Version header) only the
+    buttons and languages changed since that version are returned; if that
+    version is too old the full config is sent instead.
+    """
+    version, digest, config = config_snapshot(user_id)
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "X-Config-Version": str(version), "Cache-Control": "no-cache"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if since is not None:
+        changes = config_delta(since, user_id)
+        if changes is not None:
+            return JSONResponse({"version": version, "since": since, "changes": changes}, headers=headers)
+    return JSONResponse(config, headers=headers)
 
 @app.get("/history")
-def get_history():
-    return HISTORY
+async def get_history(limit: int = 20, user_id: Optional[str] = None, device_id: Optional[str] = None,
+                      button: Optional[str] = None, language: Optional[str] = None,
+                      since: Optional[str] = None, until: Optional[str] = None,
+                      cursor: Optional[str] = None):
+    """Stored events, newest first, one page at a time.
+
+    Pass next_cursor from the response as cursor to fetch older events.
+    """
+    try:
+        events, next_cursor = await _IO_STAGE.run(
+            query_events, user_id, device_id, button, language, since, until, limit, cursor)
+    except Overloaded:
+        return _overloaded_response()
+    except ValueError as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+    return {"ok": True, "events": [{k: v for k, v in e.items() if k != "audio"} for e in events],
+            "next_cursor": next_cursor}
 
 @app.post("/register_device")
 def register_device_endpoint(req: Dict[str, Any]):
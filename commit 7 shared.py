@@ -18,36 +18,43 @@ VOICES = {
     "it": "Alice",     
 }
 
-def speak_text(text, language="en"):
-   
+def speak_text(text, language="en", priority=None):
+    """Queue text for local playback and return immediately.
+
+    Lower priority values play first; PRIORITY_EMERGENCY interrupts
+    whatever is currently playing.
+    """
     if not text or not text.strip():
         return
-    
-    try:
-       
-        voice_name = VOICES.get(language, "Samantha")
-        
-     
-        if platform.system() == "Darwin":  
-            subprocess.run(
-                ["say", "-v", voice_name, text],
-                check=True
-            )
-        else:
-            print(f"TTS not supported on this platform. Text: {text}")
-    
-    except Exception as e:
-        print(f"TTS Error: {str(e)}")
+    _PLAYBACK.enqueue(text, language, PRIORITY_NORMAL if priority is None else priority)
 
 import json
 import os
+import base64
+import collections
+import collections.abc
+import concurrent.futures
+import copy
 import hashlib
+import itertools
+import queue
+import re
 import secrets
+import sqlite3
+import sys
+import threading
+import time
+import uuid
 from typing import Optional
 
+try:
+    import fcntl
+except ImportError:  # Windows: config saves fall back to the in-process lock only
+    fcntl = None
+
 USERS_FILE = os.path.join(os.path.dirname(__file__), "users.json")
 
-def _load_users():
+def _read_users_file():
     if not os.path.exists(USERS_FILE):
         return {}
     try:
@@ -56,10 +63,16 @@ def _load_users():
     except Exception:
         return {}
 
-def _save_users(users: dict):
+def _write_users_file(users: dict):
     with open(USERS_FILE, "w", encoding="utf-8") as f:
         json.dump(users, f, indent=2)
 
+def _load_users():
+    return _storage().all_users()
+
+def _save_users(users: dict):
+    _storage().save_users(users)
+
 def _hash_password(password: str, salt: Optional[str] = None):
     if salt is None:
         salt = secrets.token_hex(8)
@@ -74,21 +87,15 @@ def _verify_password(stored: str, password: str) -> bool:
         return False
 
 def get_user_by_email(email: str) -> Optional[dict]:
-    users = _load_users()
-    return users.get(email.lower())
+    return _USER_CACHE.get(email.lower())
 
 def user_signup(email: str, password: str, primary_account: bool = True, name: str = "", phone: str = "", security_question: str = "", security_answer: str = "") -> dict:
 
-    users = _load_users()
     key = email.lower()
-    
-    if key in users:
-        return {"success": False, "message": "Email already registered"}
-    
     pwd_hash = _hash_password(password)
     account_type = "primary" if primary_account else "caretaker"
     
-    users[key] = {
+    user = {
         "full_name": name,
         "phone": phone,
         "email": email,
@@ -101,7 +108,8 @@ def user_signup(email: str, password: str, primary_account: bool = True, name: s
         "medicines": [],
         "theme": "light",
     }
-    _save_users(users)
+    if not _storage().add_user(key, user):
+        return {"success": False, "message": "Email already registered"}
     return {
         "success": True,
         "message": "Account created successfully"
@@ -128,14 +136,12 @@ def verify_security_answer(email: str, answer: str) -> bool:
     return hashlib.sha256(answer.strip().lower().encode("utf-8")).hexdigest() == expected
 
 def reset_password(email: str, new_password: str):
-    users = _load_users()
     key = email.lower()
-    user = users.get(key)
+    user = _storage().get_user(key)
     if not user:
         raise ValueError("No account found")
     user["password_hash"] = _hash_password(new_password)
-    users[key] = user
-    _save_users(users)
+    _storage().put_user(key, user)
     return True
 
 
@@ -152,7 +158,7 @@ SECURITY_QUESTIONS = [
 ]
 
 
-CONFIG = {
+DEFAULT_CONFIG = {
     "BTN1": {
         "label": "Help",
         "texts": {
@@ -221,14 +227,407 @@ CONFIG = {
     },
 }
 
+CONFIG_FILE = os.path.join(os.path.dirname(__file__), "config.json")
+CONFIG_HISTORY = int(os.environ.get("CONFIG_HISTORY", "50"))
+CONFIG_RELOAD_INTERVAL = float(os.environ.get("CONFIG_RELOAD_INTERVAL", "1.0"))
+CONFIG_VIEW_CACHE = int(os.environ.get("CONFIG_VIEW_CACHE", "1024"))
+
+
+def _config_delta(old: dict, new: dict) -> dict:
+    """Buttons, labels and texts that differ between two configs; removed entries map to None."""
+    changes = {}
+    for button in old.keys() | new.keys():
+        before, after = old.get(button), new.get(button)
+        if before == after:
+            continue
+        if before is None or after is None:
+            changes[button] = after
+            continue
+        change = {key: after.get(key) for key in before.keys() | after.keys()
+                  if key != "texts" and before.get(key) != after.get(key)}
+        old_texts, new_texts = before.get("texts", {}), after.get("texts", {})
+        texts = {lang: new_texts.get(lang) for lang in old_texts.keys() | new_texts.keys()
+                 if old_texts.get(lang) != new_texts.get(lang)}
+        if texts:
+            change["texts"] = texts
+        changes[button] = change
+    return changes
+
+
+def _apply_config_changes(config: dict, changes: dict):
+    """Apply changes in _config_delta() form to config in place; None removes an entry."""
+    for button, change in changes.items():
+        if change is None:
+            config.pop(button, None)
+            continue
+        entry = config.setdefault(button, {})
+        for key, value in change.items():
+            if key != "texts":
+                if value is None:
+                    entry.pop(key, None)
+                else:
+                    entry[key] = value
+                continue
+            texts = entry.setdefault("texts", {})
+            for language, text in value.items():
+                if text is None:
+                    texts.pop(language, None)
+                else:
+                    texts[language] = text
+            if not texts:
+                del entry["texts"]
+        if not entry:
+            del config[button]
+
+
+class ConfigStore:
+    """Persisted button config: shared defaults plus per-user overrides.
+
+    Every edit builds a new document that replaces the previous one in a
+    single assignment (copy-on-write), so readers take no lock and never see
+    a half-applied edit; configs handed out must be treated as read-only.
+    The stored version is checked at most every reload_interval seconds, so
+    edits made by another process (the server, another Streamlit instance)
+    are picked up without a restart, and the document is only re-read when
+    it actually changed. Subscribers are called with (old_version,
+    new_version) after every change, local or reloaded.
+    """
+
+    def __init__(self, defaults: dict, keep: int = CONFIG_HISTORY,
+                 reload_interval: float = CONFIG_RELOAD_INTERVAL):
+        self._defaults = defaults
+        self.keep = keep
+        self.reload_interval = reload_interval
+        self._lock = threading.RLock()
+        self._doc = None
+        self._token = None
+        self._digest = None
+        self._checked = 0.0
+        self._history = collections.OrderedDict()
+        self._views = collections.OrderedDict()
+        self._subscribers = []
+
+    def _document(self) -> dict:
+        doc = self._doc
+        if doc is None or time.monotonic() - self._checked >= self.reload_interval:
+            doc = self.refresh()
+        return doc
+
+    @staticmethod
+    def _content_digest(doc: dict) -> str:
+        raw = json.dumps(doc, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _install(self, doc: dict, digest: str = None):
+        self._digest = digest or self._content_digest(doc)
+        self._history[doc["version"]] = doc
+        while len(self._history) > self.keep:
+            self._history.popitem(last=False)
+        self._doc = doc
+
+    def refresh(self) -> dict:
+        """Reload from storage if it changed there; returns the current document."""
+        with self._lock:
+            self._checked = time.monotonic()
+            old = self._doc
+            token = _storage().config_version()
+            if old is not None and token == self._token:
+                return old
+            doc = _storage().load_config()
+            if doc is None:
+                doc = {"version": 0, "base": copy.deepcopy(self._defaults), "users": {}}
+            self._token = token
+            # Same version is not enough: a racing writer may have replaced it with other content.
+            digest = self._content_digest(doc)
+            if old is not None and doc["version"] == old["version"] and digest == self._digest:
+                return old
+            self._install(doc, digest)
+        if old is not None:
+            self._notify(old["version"], doc["version"])
+        return doc
+
+    def update(self, changes: dict, user_id: str = None) -> int:
+        """Apply changes to the defaults, or to one user's overrides; returns the new version."""
+        with self._lock:
+            for _ in range(3):
+                old = self.refresh()
+                # Only the part being edited is copied; everything else is shared with `old`.
+                doc = {"version": old["version"] + 1, "base": old["base"], "users": dict(old["users"])}
+                if user_id is None:
+                    doc["base"] = copy.deepcopy(old["base"])
+                    _apply_config_changes(doc["base"], changes)
+                else:
+                    overrides = copy.deepcopy(old["users"].get(user_id, {}))
+                    _apply_config_changes(overrides, changes)
+                    if overrides:
+                        doc["users"][user_id] = overrides
+                    else:
+                        doc["users"].pop(user_id, None)
+                if _storage().save_config(doc, old["version"]):
+                    self._token = _storage().config_version()
+                    self._install(doc)
+                    break
+                # Another process saved first: reload and apply on top of its version.
+                self._token = None
+            else:
+                raise RuntimeError("Config is being changed concurrently, try again")
+        self._notify(old["version"], doc["version"])
+        return doc["version"]
+
+    @staticmethod
+    def _merged(doc: dict, user_id: Optional[str]) -> dict:
+        overrides = doc["users"].get(user_id) if user_id else None
+        if not overrides:
+            return doc["base"]
+        config = copy.deepcopy(doc["base"])
+        _apply_config_changes(config, overrides)
+        return config
+
+    def view(self, user_id: str = None):
+        """Return (version, hash, config) for the defaults or one user's merged config."""
+        doc = self._document()
+        # Keyed by the document itself (pinned in the entry) so a same-version replacement misses.
+        key = (doc["version"], id(doc), user_id if user_id in doc["users"] else None)
+        cached = self._views.get(key)
+        if cached is None or cached[2] is not doc:
+            config = self._merged(doc, key[2])
+            raw = json.dumps(config, sort_keys=True, ensure_ascii=False)
+            cached = (hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32], config, doc)
+            with self._lock:
+                self._views[key] = cached
+                while len(self._views) > CONFIG_VIEW_CACHE:
+                    self._views.popitem(last=False)
+        return doc["version"], cached[0], cached[1]
+
+    def delta(self, since: int, user_id: str = None) -> Optional[dict]:
+        """Changes from version `since` to now, or None if that version is not retained."""
+        version, _, config = self.view(user_id)
+        old = self._history.get(since)
+        if old is None:
+            return None
+        return {} if since == version else _config_delta(self._merged(old, user_id), config)
+
+    def changed_phrases(self, old_version: int, new_version: int) -> Optional[list]:
+        """(text, language) pairs added between two versions, for any user; None if unknown."""
+        old, new = self._history.get(old_version), self._history.get(new_version)
+        if old is None or new is None or old_version == new_version:
+            return None
+        user_ids = [None] + [u for u in new["users"] if new["users"][u] != old["users"].get(u)]
+        phrases = []
+        for user_id in user_ids:
+            changes = _config_delta(self._merged(old, user_id), self._merged(new, user_id))
+            for change in changes.values():
+                for language, text in ((change or {}).get("texts") or {}).items():
+                    if text and (text, language) not in phrases:
+                        phrases.append((text, language))
+        return phrases
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def _notify(self, old_version: int, new_version: int):
+        for callback in list(self._subscribers):
+            try:
+                callback(old_version, new_version)
+            except Exception as e:
+                print(f"Config subscriber error: {e}")
+
+
+_CONFIG_STORE = ConfigStore(DEFAULT_CONFIG)
+
+
+class _ConfigView(collections.abc.Mapping):
+    """Read-only view of the current default button config; change it with update_config()."""
+
+    def __getitem__(self, button):
+        return _CONFIG_STORE.view()[2][button]
+
+    def __iter__(self):
+        return iter(_CONFIG_STORE.view()[2])
+
+    def __len__(self):
+        return len(_CONFIG_STORE.view()[2])
+
+
+CONFIG = _ConfigView()
+
+
+def get_config(user_id: str = None) -> dict:
+    """Current button config, with the user's overrides applied. Do not modify the result."""
+    return _CONFIG_STORE.view(user_id)[2]
+
+
+def config_snapshot(user_id: str = None):
+    """Return (version, content hash, config) for the defaults or one user's config."""
+    return _CONFIG_STORE.view(user_id)
+
+
+def config_delta(since: int, user_id: str = None) -> Optional[dict]:
+    """Changed buttons and languages since a config version; None means fetch the full config."""
+    return _CONFIG_STORE.delta(since, user_id)
+
+
+def update_config(changes: dict, user_id: str = None) -> int:
+    """Persist config changes, e.g. {"BTN3": {"label": "Drink", "texts": {"en": "Water please"}}}.
+
+    With user_id the changes become that user's overrides, and None removes
+    an override again; without it they change the defaults. Returns the new
+    config version.
+    """
+    return _CONFIG_STORE.update(changes, user_id)
+
+
+def subscribe_config(callback):
+    """Call callback(old_version, new_version) whenever the config changes, in this or another process."""
+    _CONFIG_STORE.subscribe(callback)
+
 
-HISTORY = []
+def unsubscribe_config(callback):
+    _CONFIG_STORE.unsubscribe(callback)
+
+
+_config_watcher = None
+
+
+def watch_config(interval: float = None):
+    """Poll storage for config edits from other processes so subscribers hear about them promptly."""
+    global _config_watcher
+    interval = CONFIG_RELOAD_INTERVAL if interval is None else interval
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                _CONFIG_STORE.refresh()
+            except Exception as e:
+                print(f"Config reload error: {e}")
+
+    if _config_watcher is None:
+        _config_watcher = threading.Thread(target=run, name="config-watcher", daemon=True)
+        _config_watcher.start()
+
+
+HISTORY_CAPACITY = int(os.environ.get("HISTORY_CAPACITY", "10000"))
+HISTORY_MAX_BYTES = int(os.environ.get("HISTORY_MAX_BYTES", str(8 * 1024 * 1024)))
+HISTORY_PER_KEY = int(os.environ.get("HISTORY_PER_KEY", "200"))
+
+_HISTORY_FIELDS = ("button", "language", "text", "source", "device_id", "user_id", "timestamp", "event_id")
+# Low-cardinality fields are interned so thousands of records share one string.
+_HISTORY_INTERNED = {"button", "language", "source", "device_id", "user_id"}
+
+
+class _HistoryRecord:
+    """Compact fixed-field copy of an event kept in the in-memory history."""
+
+    __slots__ = ("values", "size")
+
+    def __init__(self, event: dict):
+        values = []
+        size = sys.getsizeof(self) + 8 * len(_HISTORY_FIELDS)
+        for field in _HISTORY_FIELDS:
+            value = event.get(field)
+            if isinstance(value, str):
+                if field in _HISTORY_INTERNED:
+                    value = sys.intern(value)
+                else:
+                    size += sys.getsizeof(value)
+            values.append(value)
+        self.values = tuple(values)
+        self.size = size + sys.getsizeof(self.values)
+
+    def to_dict(self) -> dict:
+        return dict(zip(_HISTORY_FIELDS, self.values))
+
+
+class EventHistory:
+    """Fixed-capacity ring buffer of recent events with per-user and per-device tails.
+
+    The buffer holds at most `capacity` records and roughly `max_bytes` of
+    record memory; the oldest records are dropped first. Each user and device
+    also gets a tail view of its last `per_key` records.
+    """
+
+    def __init__(self, capacity: int = HISTORY_CAPACITY, max_bytes: int = HISTORY_MAX_BYTES,
+                 per_key: int = HISTORY_PER_KEY):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.per_key = per_key
+        self._lock = threading.Lock()
+        self._records = collections.deque()
+        self._by_user = {}
+        self._by_device = {}
+        self._bytes = 0
+        self.dropped = 0
+
+    def _drop_oldest(self):
+        record = self._records.popleft()
+        self._bytes -= record.size
+        self.dropped += 1
+        user_id, device_id = record.values[5], record.values[4]
+        for index, key in ((self._by_user, user_id), (self._by_device, device_id)):
+            view = index.get(key)
+            if view and view[0] is record:
+                view.popleft()
+            if view is not None and not view:
+                del index[key]
+
+    def append(self, event: dict):
+        record = _HistoryRecord(event)
+        with self._lock:
+            self._records.append(record)
+            self._bytes += record.size
+            for index, key in ((self._by_user, record.values[5]), (self._by_device, record.values[4])):
+                view = index.get(key)
+                if view is None:
+                    view = index[key] = collections.deque(maxlen=self.per_key)
+                view.append(record)
+            while self._records and (len(self._records) > self.capacity or self._bytes > self.max_bytes):
+                self._drop_oldest()
+
+    def tail(self, n: int = 50, user_id: str = None, device_id: str = None) -> list:
+        """Return up to n most recent events (oldest first), optionally for one user or device."""
+        with self._lock:
+            if user_id is not None:
+                source = self._by_user.get(user_id, ())
+            elif device_id is not None:
+                source = self._by_device.get(device_id, ())
+            else:
+                source = self._records
+            records = list(itertools.islice(reversed(source), n))
+        if user_id is not None and device_id is not None:
+            records = [r for r in records if r.values[4] == device_id]
+        return [record.to_dict() for record in reversed(records)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "events": len(self._records),
+                "capacity": self.capacity,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "dropped": self.dropped,
+            }
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        with self._lock:
+            records = list(self._records)
+        return (record.to_dict() for record in records)
+
+
+HISTORY = EventHistory()
 
 DEVICES_FILE = os.path.join(os.path.dirname(__file__), "devices.json")
 EVENTS_FILE = os.path.join(os.path.dirname(__file__), "events.json")
 
 
-def _load_devices():
+def _read_devices_file():
     """Load devices from file."""
     if not os.path.exists(DEVICES_FILE):
         return {}
@@ -239,202 +638,2629 @@ def _load_devices():
         return {}
 
 
-def _save_devices(devices: dict):
+def _write_devices_file(devices: dict):
     """Save devices to file."""
     with open(DEVICES_FILE, "w", encoding="utf-8") as f:
         json.dump(devices, f, indent=2)
 
 
-def _load_events():
-    """Load events from file."""
-    if not os.path.exists(EVENTS_FILE):
-        return []
+def _load_devices():
+    """Load all devices, keyed by user_id then device_id."""
+    return _storage().all_devices()
+
+
+EVENTS_LOG_FILE = os.path.join(os.path.dirname(__file__), "events.jsonl")
+
+# Number of appended events between fsync() calls. 1 = fsync every event,
+# 0 = never fsync explicitly (the OS flushes on its own schedule).
+EVENTS_FSYNC_EVERY = int(os.environ.get("EVENTS_FSYNC_EVERY", "1"))
+
+_events_lock = threading.Lock()
+_events_fp = None
+_events_unsynced = 0
+
+
+def _migrate_events_json():
+    """One-shot migration of the legacy events.json array into events.jsonl."""
+    if not os.path.exists(EVENTS_FILE) or os.path.exists(EVENTS_LOG_FILE):
+        return
     try:
         with open(EVENTS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return []
+            legacy = json.load(f)
+    except Exception as e:
+        print(f"Event migration skipped: {e}")
+        return
+    tmp_path = EVENTS_LOG_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for event in legacy:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, EVENTS_LOG_FILE)
+    os.replace(EVENTS_FILE, EVENTS_FILE + ".migrated")
 
 
-def _save_events(events: list):
-    """Save events to file."""
-    with open(EVENTS_FILE, "w", encoding="utf-8") as f:
-        json.dump(events, f, indent=2)
+def _append_event_log(*events: dict):
+    """Append events to the log without touching the existing entries."""
+    global _events_fp, _events_unsynced
+    lines = "".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events)
+    with _events_lock:
+        if _events_fp is None:
+            _migrate_events_json()
+            _events_fp = open(EVENTS_LOG_FILE, "a", encoding="utf-8", buffering=64 * 1024)
+        _events_fp.write(lines)
+        _events_fp.flush()
+        _events_unsynced += len(events)
+        if EVENTS_FSYNC_EVERY and _events_unsynced >= EVENTS_FSYNC_EVERY:
+            os.fsync(_events_fp.fileno())
+            _events_unsynced = 0
 
 
-def register_device(user_id: str, device_id: str, device_name: str) -> dict:
-    """Register a new device for a user."""
-    devices = _load_devices()
-    if user_id not in devices:
-        devices[user_id] = {}
-    
-    devices[user_id][device_id] = {
-        "device_id": device_id,
-        "device_name": device_name,
-        "registered_at": None,
-    }
-    _save_devices(devices)
-    return devices[user_id][device_id]
+def _iter_event_log():
+    """Stream events from the log one at a time, oldest first."""
+    _migrate_events_json()
+    if not os.path.exists(EVENTS_LOG_FILE):
+        return
+    with open(EVENTS_LOG_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                # Partially written last line from a concurrent writer.
+                break
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
 
 
-def get_user_devices(user_id: str) -> dict:
-    """Get all devices registered for a user."""
-    devices = _load_devices()
-    return devices.get(user_id, {})
+def _iter_event_log_reverse(before: int = None):
+    """Stream (byte offset, event) from the log newest first, reading backwards from the end.
 
+    With before, only lines starting before that offset are returned.
+    """
+    _migrate_events_json()
+    if not os.path.exists(EVENTS_LOG_FILE):
+        return
+    with open(EVENTS_LOG_FILE, "rb") as f:
+        position = f.seek(0, os.SEEK_END)
+        if before is not None:
+            position = min(position, before)
+        buffer = b""
+        seen_newline = False
+        while position > 0:
+            size = min(64 * 1024, position)
+            position -= size
+            f.seek(position)
+            buffer = f.read(size) + buffer
+            parts = buffer.split(b"\n")
+            if not seen_newline:
+                if len(parts) == 1:
+                    continue
+                # Whatever follows the last newline is a partially written line (or nothing).
+                parts.pop()
+                seen_newline = True
+            # parts[0] may be the end of a line that started in an earlier block.
+            buffer = parts[0]
+            offset = position + len(buffer) + 1
+            lines = []
+            for line in parts[1:]:
+                lines.append((offset, line))
+                offset += len(line) + 1
+            for offset, line in reversed(lines):
+                try:
+                    yield offset, json.loads(line)
+                except ValueError:
+                    continue
+        if seen_newline and buffer:
+            try:
+                yield 0, json.loads(buffer)
+            except ValueError:
+                pass
 
-def trigger(button: str, language: str = "en", source: str = "UI", custom_text: str = None, 
-            device_id: str = "unknown", user_id: str = "default") -> dict:
-    """Trigger an event and generate audio."""
-    text = custom_text or CONFIG.get(button, {}).get("texts", {}).get(language, "Button pressed")
-    
-    
-    audio_bytes = None
+
+def _rewrite_event_log(events: list):
+    """Rewrite the whole event log. Only needed for bulk edits; use _append_event_log for new events."""
+    global _events_fp
+    with _events_lock:
+        if _events_fp is not None:
+            _events_fp.close()
+            _events_fp = None
+        tmp_path = EVENTS_LOG_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, EVENTS_LOG_FILE)
+
+
+def iter_events():
+    """Stream stored events one at a time, oldest first."""
+    return _storage().iter_events()
+
+
+HISTORY_PAGE_MAX = int(os.environ.get("HISTORY_PAGE_MAX", "200"))
+
+
+def _event_matches(event: dict, filters: dict) -> bool:
+    for key in ("user_id", "device_id", "button", "language"):
+        if filters.get(key) is not None and event.get(key) != filters[key]:
+            return False
+    timestamp = event.get("timestamp") or ""
+    if filters.get("since") and timestamp < filters["since"]:
+        return False
+    if filters.get("until") and timestamp >= filters["until"]:
+        return False
+    return True
+
+
+def _encode_cursor(event_row_id: int) -> str:
+    return base64.urlsafe_b64encode(f"e1:{event_row_id}".encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> int:
     try:
-        import io
-        import threading
-        from gtts import gTTS
-        
-        def get_audio():
-            nonlocal audio_bytes
-            try:
-                tts = gTTS(text=text, lang=language[:2], slow=False)
-                audio_buffer = io.BytesIO()
-                tts.write_to_fp(audio_buffer)
-                audio_buffer.seek(0)
-                audio_bytes = audio_buffer.read()
-            except Exception as e:
-                print(f"gTTS error: {e}")
-                audio_bytes = None
-        
-        # Run gTTS in a thread with timeout
-        thread = threading.Thread(target=get_audio)
-        thread.daemon = True
-        thread.start()
-        thread.join(timeout=5)  # 5 second timeout
-        
-        if thread.is_alive():
-            print("Audio generation timed out, continuing without audio")
-            audio_bytes = None
-    except Exception as e:
-        print(f"Audio generation error: {e}")
-        audio_bytes = None
-        # Fallback: Try to use local TTS
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        prefix, _, value = raw.partition(":")
+        if prefix != "e1":
+            raise ValueError
+        return int(value)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+def query_events(user_id: str = None, device_id: str = None, button: str = None,
+                 language: str = None, since: str = None, until: str = None,
+                 limit: int = 50, cursor: str = None):
+    """Page through stored events, newest first.
+
+    since/until are ISO timestamps (until is exclusive). Returns (events,
+    next_cursor); pass next_cursor back to get the following page, it is
+    None on the last one. Raises ValueError for a malformed cursor.
+    """
+    filters = {"user_id": user_id, "device_id": device_id, "button": button,
+               "language": language, "since": since, "until": until}
+    before = _decode_cursor(cursor) if cursor else None
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    # One extra row tells whether another page follows.
+    rows = _storage().query_events(filters, before, limit + 1)
+    next_cursor = _encode_cursor(rows[limit - 1][0]) if len(rows) > limit else None
+    return [event for _, event in rows[:limit]], next_cursor
+
+
+def event_log_position():
+    """Opaque position just past the newest stored event, for read_events_since()."""
+    return _storage().events_position()
+
+
+def read_events_since(position, limit: int = 1000):
+    """Events stored after position by any process, oldest first, and the position to continue from."""
+    return _storage().events_since(position, limit)
+
+
+def _load_events():
+    """Load events from storage."""
+    return list(iter_events())
+
+
+def _save_events(events: list):
+    """Replace all stored events."""
+    _storage().save_events(events)
+
+
+# ---------------------------------------------------------------------------
+# Storage backends
+#
+# Every user/device/event read and write in this module goes through
+# _storage(). JsonStorage keeps the original users.json / devices.json /
+# events.jsonl files; SqliteStorage keeps everything in one WAL-mode
+# database so single-record reads and writes are index lookups instead of
+# whole-file rewrites. Select with ASSISTIVE_STORAGE=json|sqlite or
+# set_storage().
+# ---------------------------------------------------------------------------
+
+STORAGE_BACKEND = os.environ.get("ASSISTIVE_STORAGE", "json")
+DB_FILE = os.environ.get("ASSISTIVE_DB", os.path.join(os.path.dirname(__file__), "assistive.db"))
+
+
+class JsonStorage:
+    """Storage on the original JSON files."""
+
+    # JSON reads are whole-file, so the user cache loads everything at once.
+    bulk_users = True
+
+    def __init__(self):
+        self.users_generation = 0
+
+    def users_version(self):
+        """Token that changes whenever users.json is rewritten, by any process."""
         try:
-            speak_text(text, language)
-        except:
-            pass
-    
-  
-    import datetime
-    event = {
-        "button": button,
-        "language": language,
-        "text": text,
-        "source": source,
-        "device_id": device_id,
-        "user_id": user_id,
-        "timestamp": datetime.datetime.now().isoformat(),
-        "audio": None, 
-    }
-    
-  
-    HISTORY.append(event)
-    events = _load_events()
-    events.append(event)
-    _save_events(events)
-    
-    return {
-        "button": button,
-        "text": text,
-        "language": language,
-        "audio": audio_bytes,
-        "timestamp": event["timestamp"],
-    }
+            st = os.stat(USERS_FILE)
+            return (self.users_generation, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return (self.users_generation, None, None)
 
+    def config_version(self):
+        try:
+            st = os.stat(CONFIG_FILE)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
 
-def add_caretaker(primary_email: str, caretaker_email: str) -> bool:
-    """Add a caretaker relationship between a primary user and a caretaker."""
-    users = _load_users()
-    primary_key = primary_email.lower()
-    caretaker_key = caretaker_email.lower()
-    
-    if primary_key not in users or caretaker_key not in users:
-        raise ValueError("One or both users not found")
-    
-    if "caretakers" not in users[primary_key]:
-        users[primary_key]["caretakers"] = []
-    
-    if caretaker_key not in users[primary_key]["caretakers"]:
-        users[primary_key]["caretakers"].append(caretaker_key)
-    
-    _save_users(users)
-    return True
+    def load_config(self) -> Optional[dict]:
+        if not os.path.exists(CONFIG_FILE):
+            return None
+        try:
+            with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Config load error: {e}")
+            return None
 
+    def save_config(self, doc: dict, expected_version: int) -> bool:
+        # The lock makes compare-and-replace atomic across processes, not just threads.
+        with open(CONFIG_FILE + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            current = self.load_config()
+            if (current["version"] if current else 0) != expected_version:
+                return False
+            # Written aside and renamed, so readers in other processes never see half a file.
+            tmp_path = CONFIG_FILE + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(doc, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, CONFIG_FILE)
+            return True
 
-def get_accessible_accounts(email: str) -> list:
-    """Get list of accounts that this user can access (for caretakers)."""
-    users = _load_users()
-    user_key = email.lower()
-    accessible = []
-    
-    
-    for user_email, user_data in users.items():
-        if "caretakers" in user_data and user_key in user_data["caretakers"]:
-            accessible.append({
-                "email": user_data.get("email"),
-                "full_name": user_data.get("full_name"),
-            })
-    
-    return accessible
+    def get_user(self, key: str) -> Optional[dict]:
+        return _read_users_file().get(key)
 
+    def all_users(self) -> dict:
+        return _read_users_file()
 
-def get_user_profile(email: str) -> Optional[dict]:
-    """Get user profile information."""
-    user = get_user_by_email(email)
-    if not user:
-        return None
-    
-   
-    return {
-        "full_name": user.get("full_name"),
-        "email": user.get("email"),
-        "phone": user.get("phone"),
-        "account_type": user.get("account_type"),
-    }
+    def add_user(self, key: str, user: dict) -> bool:
+        users = _read_users_file()
+        if key in users:
+            return False
+        users[key] = user
+        _write_users_file(users)
+        self.users_generation += 1
+        return True
 
+    def put_user(self, key: str, user: dict):
+        users = _read_users_file()
+        users[key] = user
+        _write_users_file(users)
+        self.users_generation += 1
 
-def set_user_theme(email: str, theme: str) -> bool:
-    """Set user theme preference."""
-    users = _load_users()
-    user_key = email.lower()
-    
-    if user_key not in users:
-        raise ValueError("User not found")
-    
-    users[user_key]["theme"] = theme
-    _save_users(users)
-    return True
+    def save_users(self, users: dict):
+        _write_users_file(users)
+        self.users_generation += 1
 
+    def get_devices(self, user_id: str) -> dict:
+        return _read_devices_file().get(user_id, {})
 
-def get_user_medicines(email: str) -> list:
-    """Get list of medicines for a user."""
-    user = get_user_by_email(email)
-    if not user:
-        return []
-    
-    return user.get("medicines", [])
+    def all_devices(self) -> dict:
+        return _read_devices_file()
 
+    def put_device(self, user_id: str, device_id: str, device: dict):
+        devices = _read_devices_file()
+        devices.setdefault(user_id, {})[device_id] = device
+        _write_devices_file(devices)
+
+    def append_event(self, event: dict):
+        _append_event_log(event)
+
+    def append_events(self, events: list):
+        _append_event_log(*events)
+
+    def iter_events(self):
+        return _iter_event_log()
+
+    def events_position(self) -> int:
+        try:
+            return os.path.getsize(EVENTS_LOG_FILE)
+        except OSError:
+            return 0
+
+    def events_since(self, position: int, limit: int):
+        # Positions are byte offsets into the log; only complete lines are consumed.
+        size = self.events_position()
+        if size < position:
+            # The log was rewritten; carry on from its new end.
+            return [], size
+        if size == position:
+            return [], position
+        events = []
+        with open(EVENTS_LOG_FILE, "rb") as f:
+            f.seek(position)
+            for line in f:
+                if not line.endswith(b"\n") or len(events) >= limit:
+                    break
+                position += len(line)
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+        return events, position
+
+    def max_seq(self, device_id: str, boot_id: str) -> int:
+        # Only asked once per (device, boot) per process, so a full scan is acceptable here.
+        highest = 0
+        for event in _iter_event_log():
+            if (event.get("device_id") == device_id and event.get("boot_id", "") == boot_id
+                    and event.get("seq") is not None):
+                highest = max(highest, event["seq"])
+        return highest
+
+    def query_events(self, filters: dict, before: Optional[int], limit: int) -> list:
+        # Ids are byte offsets of lines in the log, read backwards from the
+        # cursor, so a page only parses back as far as its oldest match.
+        matches = []
+        for offset, event in _iter_event_log_reverse(before):
+            if _event_matches(event, filters):
+                matches.append((offset, event))
+                if len(matches) >= limit:
+                    break
+        return matches
+
+    def save_events(self, events: list):
+        _rewrite_event_log(events)
+
+
+class SqliteStorage:
+    """Storage in a single SQLite database running in WAL mode."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            email TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS devices (
+            user_id TEXT NOT NULL,
+            device_id TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (user_id, device_id)
+        );
+        CREATE TABLE IF NOT EXISTS caretakers (
+            primary_email TEXT NOT NULL,
+            caretaker_email TEXT NOT NULL,
+            PRIMARY KEY (primary_email, caretaker_email)
+        );
+        CREATE INDEX IF NOT EXISTS idx_caretakers_caretaker ON caretakers (caretaker_email);
+        CREATE INDEX IF NOT EXISTS idx_devices_device_id ON devices (device_id);
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            device_id TEXT,
+            button TEXT,
+            language TEXT,
+            timestamp TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_events_user_id ON events (user_id, id);
+        CREATE INDEX IF NOT EXISTS idx_events_device_id ON events (device_id, id);
+        CREATE INDEX IF NOT EXISTS idx_events_timestamp ON events (timestamp);
+        CREATE INDEX IF NOT EXISTS idx_events_user_button ON events (user_id, button, id);
+        CREATE TABLE IF NOT EXISTS config (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+    """
+
+    bulk_users = False
+
+    def __init__(self, path: str = None):
+        self.path = path or DB_FILE
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+        self._watch_conn = None
+        self._watch_lock = threading.Lock()
+
+    def users_version(self):
+        """Token that changes after any commit to the database, by any connection."""
+        self._conn()
+        with self._watch_lock:
+            if self._watch_conn is None:
+                self._watch_conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            # data_version only moves when *other* connections commit, and every
+            # reader/writer thread has its own connection, so this sees them all.
+            return self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def config_version(self):
+        # The content is part of the token, so a same-version replacement is noticed too.
+        row = self._conn().execute("SELECT version, data FROM config WHERE id = 1").fetchone()
+        return (row[0], hashlib.sha256(row[1].encode("utf-8")).digest()) if row else None
+
+    def load_config(self) -> Optional[dict]:
+        row = self._conn().execute("SELECT data FROM config WHERE id = 1").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_config(self, doc: dict, expected_version: int) -> bool:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT version FROM config WHERE id = 1").fetchone()
+            if (row[0] if row else 0) != expected_version:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("INSERT OR REPLACE INTO config (id, version, data) VALUES (1, ?, ?)",
+                         (doc["version"], json.dumps(doc, ensure_ascii=False)))
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=%s" % ("FULL" if EVENTS_FSYNC_EVERY == 1 else "NORMAL"))
+            self._local.conn = conn
+            with self._init_lock:
+                if not self._initialized:
+                    is_new = not conn.execute(
+                        "SELECT 1 FROM sqlite_master WHERE name = 'users'"
+                    ).fetchone()
+                    needs_caretakers = not conn.execute(
+                        "SELECT 1 FROM sqlite_master WHERE name = 'caretakers'"
+                    ).fetchone()
+                    conn.executescript(self.SCHEMA)
+                    if is_new:
+                        self._import_json(conn)
+                    elif needs_caretakers:
+                        self._backfill_caretakers(conn)
+                    self._initialized = True
+        return conn
+
+    def _import_json(self, conn):
+        """Copy existing JSON data into a freshly created database."""
+        users = _read_users_file()
+        devices = _read_devices_file()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, user in users.items():
+                self._write_user(conn, key, user)
+            conn.executemany(
+                "INSERT OR REPLACE INTO devices (user_id, device_id, data) VALUES (?, ?, ?)",
+                [(uid, did, json.dumps(dev)) for uid, devs in devices.items() for did, dev in devs.items()],
+            )
+            conn.executemany(
+                "INSERT INTO events (user_id, device_id, button, language, timestamp, data) VALUES (?, ?, ?, ?, ?, ?)",
+                (self._event_row(event) for event in _iter_event_log()),
+            )
+            config = JsonStorage().load_config()
+            if config is not None:
+                conn.execute("INSERT INTO config (id, version, data) VALUES (1, ?, ?)",
+                             (config["version"], json.dumps(config, ensure_ascii=False)))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _backfill_caretakers(self, conn):
+        """Populate the caretakers table for a database created before it existed."""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, data in conn.execute("SELECT email, data FROM users").fetchall():
+                self._write_user(conn, key, json.loads(data))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _write_user(conn, key: str, user: dict):
+        """Write a user row and its caretaker edges. Caller owns the transaction."""
+        conn.execute("INSERT OR REPLACE INTO users (email, data) VALUES (?, ?)", (key, json.dumps(user)))
+        conn.execute("DELETE FROM caretakers WHERE primary_email = ?", (key,))
+        conn.executemany(
+            "INSERT OR IGNORE INTO caretakers (primary_email, caretaker_email) VALUES (?, ?)",
+            [(key, caretaker) for caretaker in user.get("caretakers", [])],
+        )
+
+    @staticmethod
+    def _event_row(event: dict):
+        return (
+            event.get("user_id"),
+            event.get("device_id"),
+            event.get("button"),
+            event.get("language"),
+            event.get("timestamp"),
+            json.dumps(event, ensure_ascii=False),
+        )
+
+    def get_user(self, key: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT data FROM users WHERE email = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def all_users(self) -> dict:
+        rows = self._conn().execute("SELECT email, data FROM users").fetchall()
+        return {key: json.loads(data) for key, data in rows}
+
+    def add_user(self, key: str, user: dict) -> bool:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM users WHERE email = ?", (key,)).fetchone():
+                conn.execute("ROLLBACK")
+                return False
+            self._write_user(conn, key, user)
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def put_user(self, key: str, user: dict):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._write_user(conn, key, user)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def save_users(self, users: dict):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM users")
+            conn.execute("DELETE FROM caretakers")
+            for key, user in users.items():
+                self._write_user(conn, key, user)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def primaries_for(self, caretaker_keys: list) -> dict:
+        """Map each caretaker to the primary accounts that list them, via the caretakers index."""
+        result = {key: [] for key in caretaker_keys}
+        keys = list(result)
+        conn = self._conn()
+        # Stay well under SQLite's bound-parameter limit for large dashboards.
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = conn.execute(
+                "SELECT caretaker_email, primary_email FROM caretakers WHERE caretaker_email IN (%s)"
+                % ",".join("?" * len(chunk)),
+                chunk,
+            )
+            for caretaker, primary in rows:
+                result[caretaker].append(primary)
+        return result
+
+    def get_devices(self, user_id: str) -> dict:
+        rows = self._conn().execute(
+            "SELECT device_id, data FROM devices WHERE user_id = ?", (user_id,)
+        ).fetchall()
+        return {device_id: json.loads(data) for device_id, data in rows}
+
+    def all_devices(self) -> dict:
+        devices = {}
+        for user_id, device_id, data in self._conn().execute("SELECT user_id, device_id, data FROM devices"):
+            devices.setdefault(user_id, {})[device_id] = json.loads(data)
+        return devices
+
+    def put_device(self, user_id: str, device_id: str, device: dict):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO devices (user_id, device_id, data) VALUES (?, ?, ?)",
+            (user_id, device_id, json.dumps(device)),
+        )
+
+    def append_event(self, event: dict):
+        self._conn().execute(
+            "INSERT INTO events (user_id, device_id, button, language, timestamp, data) VALUES (?, ?, ?, ?, ?, ?)",
+            self._event_row(event),
+        )
+
+    def append_events(self, events: list):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO events (user_id, device_id, button, language, timestamp, data) VALUES (?, ?, ?, ?, ?, ?)",
+                [self._event_row(event) for event in events],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def events_position(self) -> int:
+        return self._conn().execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def events_since(self, position: int, limit: int):
+        rows = self._conn().execute(
+            "SELECT id, data FROM events WHERE id > ? ORDER BY id LIMIT ?", (position, limit)
+        ).fetchall()
+        return [json.loads(data) for _, data in rows], (rows[-1][0] if rows else position)
+
+    def max_seq(self, device_id: str, boot_id: str) -> int:
+        row = self._conn().execute(
+            "SELECT MAX(json_extract(data, '$.seq')) FROM events"
+            " WHERE device_id = ? AND COALESCE(json_extract(data, '$.boot_id'), '') = ?",
+            (device_id, boot_id),
+        ).fetchone()
+        return row[0] or 0
+
+    def query_events(self, filters: dict, before: Optional[int], limit: int) -> list:
+        clauses, params = [], []
+        for column in ("user_id", "device_id", "button", "language"):
+            if filters.get(column) is not None:
+                clauses.append(f"{column} = ?")
+                params.append(filters[column])
+        if filters.get("since"):
+            clauses.append("timestamp >= ?")
+            params.append(filters["since"])
+        if filters.get("until"):
+            clauses.append("timestamp < ?")
+            params.append(filters["until"])
+        if before is not None:
+            clauses.append("id < ?")
+            params.append(before)
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        rows = self._conn().execute(
+            f"SELECT id, data FROM events{where} ORDER BY id DESC LIMIT ?", params + [limit]
+        ).fetchall()
+        return [(row_id, json.loads(data)) for row_id, data in rows]
+
+    def iter_events(self):
+        # A dedicated cursor streams rows instead of materialising the table.
+        for (data,) in self._conn().execute("SELECT data FROM events ORDER BY id"):
+            yield json.loads(data)
+
+    def save_events(self, events: list):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM events")
+            conn.executemany(
+                "INSERT INTO events (user_id, device_id, button, language, timestamp, data) VALUES (?, ?, ?, ?, ?, ?)",
+                [self._event_row(event) for event in events],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class UserCache:
+    """In-memory user index, invalidated when the storage version token changes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._token = None
+        self._users = {}
+        self._complete = False
+        self._by_caretaker = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _check(self, token):
+        if token != self._token:
+            if self._token is not None:
+                self.invalidations += 1
+            self._token = token
+            self._users = {}
+            self._complete = False
+            self._by_caretaker = {}
+
+    def _fill(self, token, users: dict):
+        """Install a full user load and rebuild the caretaker -> primaries index from it."""
+        by_caretaker = {}
+        for primary, user in users.items():
+            for caretaker in user.get("caretakers", []):
+                by_caretaker.setdefault(caretaker, []).append(primary)
+        with self._lock:
+            if token == self._token:
+                self._users = users
+                self._complete = True
+                self._by_caretaker = by_caretaker
+
+    def get(self, key: str) -> Optional[dict]:
+        storage = _storage()
+        token = (id(storage), storage.users_version())
+        with self._lock:
+            self._check(token)
+            if key in self._users or self._complete:
+                self.hits += 1
+                return copy.deepcopy(self._users.get(key))
+            self.misses += 1
+
+        if storage.bulk_users:
+            users = storage.all_users()
+            self._fill(token, users)
+            return copy.deepcopy(users.get(key))
+
+        user = storage.get_user(key)
+        with self._lock:
+            if token == self._token:
+                self._users[key] = user
+        return copy.deepcopy(user)
+
+    def primaries_for(self, caretaker_keys: list) -> dict:
+        """Map each caretaker key to the list of primary keys that list it as a caretaker."""
+        storage = _storage()
+        if not storage.bulk_users:
+            return storage.primaries_for(caretaker_keys)
+        token = (id(storage), storage.users_version())
+        with self._lock:
+            self._check(token)
+            complete = self._complete
+        if not complete:
+            self._fill(token, storage.all_users())
+        with self._lock:
+            return {key: list(self._by_caretaker.get(key, [])) for key in caretaker_keys}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "cached_users": sum(1 for user in self._users.values() if user is not None),
+            }
+
+
+_USER_CACHE = UserCache()
+
+
+def user_cache_stats() -> dict:
+    """Hit/miss counters for the user cache."""
+    return _USER_CACHE.stats()
+
+
+_STORAGE = None
+_storage_lock = threading.Lock()
+
+
+def _storage():
+    """Return the active storage backend, creating it on first use."""
+    global _STORAGE
+    if _STORAGE is None:
+        with _storage_lock:
+            if _STORAGE is None:
+                _STORAGE = SqliteStorage() if STORAGE_BACKEND == "sqlite" else JsonStorage()
+    return _STORAGE
+
+
+def set_storage(storage):
+    """Swap the storage backend (e.g. set_storage(SqliteStorage("/data/assistive.db")))."""
+    global _STORAGE
+    _STORAGE = storage
+
+
+def register_device(user_id: str, device_id: str, device_name: str) -> dict:
+    """Register a new device for a user."""
+    device = {
+        "device_id": device_id,
+        "device_name": device_name,
+        "registered_at": None,
+    }
+    _storage().put_device(user_id, device_id, device)
+    return device
+
+
+_known_devices = {}
+
+
+def ensure_device(user_id: str, device_id: str, device_name: str):
+    """Register a device unless it is already stored under the same name."""
+    key = (user_id, device_id)
+    if _known_devices.get(key) == device_name:
+        return
+    stored = _storage().get_devices(user_id).get(device_id)
+    if stored is None or stored.get("device_name") != device_name:
+        register_device(user_id, device_id, device_name)
+    _known_devices[key] = device_name
+
+
+def get_user_devices(user_id: str) -> dict:
+    """Get all devices registered for a user."""
+    return _storage().get_devices(user_id)
+
+
+# ---------------------------------------------------------------------------
+# Audio cache
+#
+# Synthesized clips are cached in two tiers: an in-memory LRU bounded by a
+# byte budget, in front of a content-addressed directory on disk. Clips are
+# addressed by audio_id(text, language), so the same phrase is synthesized
+# once and then served from memory (or disk after a restart).
+# ---------------------------------------------------------------------------
+
+AUDIO_CACHE_DIR = os.environ.get("AUDIO_CACHE_DIR", os.path.join(os.path.dirname(__file__), "audio_cache"))
+AUDIO_CACHE_MEMORY_BYTES = int(os.environ.get("AUDIO_CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+TTS_TIMEOUT = 5
+
+
+def audio_id(text: str, language: str) -> str:
+    """Stable id of the clip for (text, language)."""
+    return hashlib.sha256(f"{language}\0{text}".encode("utf-8")).hexdigest()
+
+
+class AudioCache:
+    """In-memory LRU of audio clips in front of an on-disk store."""
+
+    def __init__(self, directory: str = AUDIO_CACHE_DIR, max_memory_bytes: int = AUDIO_CACHE_MEMORY_BYTES):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        self.bundle = None
+        self.memory_hits = 0
+        self.bundle_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _path(self, clip_id: str) -> str:
+        return os.path.join(self.directory, clip_id[:2], clip_id + ".mp3")
+
+    def _remember(self, clip_id: str, data: bytes):
+        with self._lock:
+            old = self._memory.pop(clip_id, None)
+            if old is not None:
+                self._memory_bytes -= len(old)
+            if len(data) > self.max_memory_bytes:
+                return
+            self._memory[clip_id] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def get_by_id(self, clip_id: str) -> Optional[bytes]:
+        """Clip bytes, or a zero-copy memoryview when served from the audio bundle."""
+        bundle = self.bundle
+        if bundle is not None:
+            view = bundle.get(clip_id)
+            if view is not None:
+                with self._lock:
+                    self.bundle_hits += 1
+                return view
+        with self._lock:
+            data = self._memory.get(clip_id)
+            if data is not None:
+                self._memory.move_to_end(clip_id)
+                self.memory_hits += 1
+                return data
+        try:
+            with open(self._path(clip_id), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        self._remember(clip_id, data)
+        return data
+
+    def get_persisted_by_id(self, clip_id: str) -> Optional[bytes]:
+        """Clip from the bundle or disk only; memory may hold fallback-voice audio."""
+        bundle = self.bundle
+        if bundle is not None:
+            view = bundle.get(clip_id)
+            if view is not None:
+                return view
+        try:
+            with open(self._path(clip_id), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put_by_id(self, clip_id: str, data: bytes, persist: bool = True):
+        if not data:
+            return
+        self._remember(clip_id, data)
+        if not persist:
+            return
+        # The new clip supersedes the bundled one.
+        bundle = self.bundle
+        if bundle is not None:
+            bundle.discard(clip_id)
+        path = self._path(clip_id)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Audio cache write error: {e}")
+
+    def evict_by_id(self, clip_id: str):
+        """Drop a clip and any transcoded variants of it from both tiers."""
+        bundle = self.bundle
+        if bundle is not None:
+            bundle.discard(clip_id)
+        with self._lock:
+            for key in [k for k in self._memory if k.startswith(clip_id)]:
+                self._memory_bytes -= len(self._memory.pop(key))
+        directory = os.path.dirname(self._path(clip_id))
+        try:
+            names = [n for n in os.listdir(directory) if n.startswith(clip_id)]
+        except OSError:
+            return
+        for name in names:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def get(self, text: str, language: str) -> Optional[bytes]:
+        return self.get_by_id(audio_id(text, language))
+
+    def put(self, text: str, language: str, data: bytes, persist: bool = True):
+        self.put_by_id(audio_id(text, language), data, persist)
+
+    def evict(self, text: str, language: str):
+        self.evict_by_id(audio_id(text, language))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "bundle_hits": self.bundle_hits,
+                "bundle_clips": len(self.bundle) if self.bundle is not None else 0,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_clips": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "max_memory_bytes": self.max_memory_bytes,
+            }
+
+
+_AUDIO_CACHE = AudioCache()
+
+
+# ---------------------------------------------------------------------------
+# Audio bundle
+#
+# build_audio_bundle() packs the clip of every CONFIG phrase into one file:
+#
+#     b"ABUNDLE1" | index length (uint32 LE) | index JSON | clip data ...
+#
+# where the index maps audio_id -> [offset, length] from the start of the
+# file. load_audio_bundle() mmaps it and the audio cache serves those clips
+# as memoryview slices, so a restart has every built-in button ready without
+# reading individual files or touching the network.
+# ---------------------------------------------------------------------------
+
+AUDIO_BUNDLE_FILE = os.environ.get("AUDIO_BUNDLE_FILE", os.path.join(os.path.dirname(__file__), "audio_bundle.bin"))
+_BUNDLE_MAGIC = b"ABUNDLE1"
+
+
+class AudioBundle:
+    """Read-only, memory-mapped audio bundle."""
+
+    def __init__(self, path: str):
+        import mmap
+        import struct
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        if bytes(self._view[:8]) != _BUNDLE_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not an audio bundle")
+        (index_length,) = struct.unpack_from("<I", self._mmap, 8)
+        self._index = json.loads(bytes(self._view[12:12 + index_length]))
+
+    def get(self, clip_id: str) -> Optional[memoryview]:
+        entry = self._index.get(clip_id)
+        if entry is None:
+            return None
+        offset, length = entry
+        return self._view[offset:offset + length]
+
+    def discard(self, clip_id: str):
+        """Stop serving a clip, e.g. because a newer one was persisted."""
+        self._index.pop(clip_id, None)
+
+    def clip_ids(self) -> list:
+        return list(self._index)
+
+    def __contains__(self, clip_id: str) -> bool:
+        return clip_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+
+
+def build_audio_bundle(path: str = AUDIO_BUNDLE_FILE, phrases: list = None) -> dict:
+    """Synthesize (or load from cache) every CONFIG phrase and pack the clips into one bundle file.
+
+    Only primary-backend audio is bundled: a phrase the primary cannot
+    synthesize is listed under missing rather than packed in the fallback voice.
+    """
+    import struct
+    phrases = config_phrases() if phrases is None else phrases
+    primary = _TTS_BACKENDS[0]
+    clips, missing = {}, []
+    for text, language in phrases:
+        clip_id = audio_id(text, language)
+        data = _AUDIO_CACHE.get_persisted_by_id(clip_id)
+        if data is None and primary.available():
+            try:
+                data = _run_primary(primary, text, language)
+                _AUDIO_CACHE.put_by_id(clip_id, data)
+            except Exception as e:
+                print(f"Bundle: could not synthesize {language} '{text}': {e}")
+        if data:
+            clips[clip_id] = bytes(data)
+        else:
+            missing.append([text, language])
+
+    # Offsets depend on the index length, which depends on the offsets'
+    # digits, so settle on a fixed point (two passes in practice).
+    index, header_length = {}, 0
+    while True:
+        offset = header_length
+        index = {}
+        for clip_id, data in clips.items():
+            index[clip_id] = [offset, len(data)]
+            offset += len(data)
+        index_json = json.dumps(index, separators=(",", ":")).encode("utf-8")
+        if 12 + len(index_json) == header_length:
+            break
+        header_length = 12 + len(index_json)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_BUNDLE_MAGIC)
+        f.write(struct.pack("<I", len(index_json)))
+        f.write(index_json)
+        for data in clips.values():
+            f.write(data)
+    os.replace(tmp_path, path)
+    return {"path": path, "clips": len(clips), "bytes": offset, "missing": missing}
+
+
+def load_audio_bundle(path: str = AUDIO_BUNDLE_FILE) -> bool:
+    """mmap an audio bundle and serve its clips from the audio cache. Returns False if there is none."""
+    if not os.path.exists(path):
+        return False
+    try:
+        bundle = AudioBundle(path)
+    except Exception as e:
+        print(f"Audio bundle not loaded: {e}")
+        return False
+    # Clips persisted after the bundle was built are newer than the bundled ones.
+    built = os.stat(path).st_mtime_ns
+    for clip_id in bundle.clip_ids():
+        try:
+            if os.stat(_AUDIO_CACHE._path(clip_id)).st_mtime_ns > built:
+                bundle.discard(clip_id)
+        except OSError:
+            pass
+    old, _AUDIO_CACHE.bundle = _AUDIO_CACHE.bundle, bundle
+    if old is not None:
+        # Views handed out earlier keep the old mapping alive until released.
+        try:
+            old.close()
+        except BufferError:
+            pass
+    return True
+
+
+def get_audio_by_id(clip_id: str) -> Optional[bytes]:
+    """Cached clip for an audio id, or None."""
+    return _AUDIO_CACHE.get_by_id(clip_id)
+
+
+# Delivery formats: mp3 (as synthesized, or re-encoded at a requested
+# bitrate), opus (Ogg/Opus, low bitrate) and pcm8k (8 kHz mono 16-bit WAV
+# for embedded speakers). Transcoding needs pydub + ffmpeg; without them the
+# original clip is served.
+AUDIO_FORMATS = {"mp3": "32k", "opus": "16k", "pcm8k": None}
+_BITRATE_RE = re.compile(r"^\d{1,3}k$")
+# Variants that failed to transcode are not retried on every request.
+_TRANSCODE_FAILED = set()
+
+
+def transcode_audio(data: bytes, fmt: str, bitrate: str = None) -> Optional[bytes]:
+    """Re-encode a clip to one of AUDIO_FORMATS. Returns None if transcoding is unavailable."""
+    import io
+    try:
+        from pydub import AudioSegment
+        segment = AudioSegment.from_file(io.BytesIO(data), format=_pydub_format(data)).set_channels(1)
+        out = io.BytesIO()
+        if fmt == "pcm8k":
+            segment.set_frame_rate(8000).set_sample_width(2).export(out, format="wav")
+        elif fmt == "opus":
+            segment.export(out, format="ogg", codec="libopus", bitrate=bitrate or AUDIO_FORMATS["opus"])
+        else:
+            segment.export(out, format="mp3", bitrate=bitrate or AUDIO_FORMATS["mp3"])
+        return out.getvalue()
+    except Exception as e:
+        print(f"Transcode error ({fmt}): {e}")
+        return None
+
+
+def get_audio_variant(clip_id: str, fmt: str = None, bitrate: str = None) -> Optional[bytes]:
+    """Clip in the requested format and bitrate, transcoding once and caching each variant."""
+    original = _AUDIO_CACHE.get_by_id(clip_id)
+    if original is None or fmt not in AUDIO_FORMATS:
+        return original
+    if bitrate is not None and not _BITRATE_RE.match(bitrate):
+        bitrate = None
+    if fmt == "mp3" and bitrate is None and audio_mime(original) == "audio/mpeg":
+        return original
+    variant_id = f"{clip_id}-{fmt}-{bitrate or 'default'}"
+    if variant_id in _TRANSCODE_FAILED:
+        return original
+    data = _AUDIO_CACHE.get_by_id(variant_id)
+    if data is not None:
+        return data
+    data = transcode_audio(original, fmt, bitrate)
+    if data is None:
+        _TRANSCODE_FAILED.add(variant_id)
+        return original
+    _AUDIO_CACHE.put_by_id(variant_id, data)
+    return data
+
+
+def audio_cache_stats() -> dict:
+    """Hit/miss counters for the audio cache."""
+    return _AUDIO_CACHE.stats()
+
+
+def audio_mime(data: bytes) -> str:
+    """MIME type of an audio clip, sniffed from its header."""
+    if data[:4] == b"RIFF":
+        return "audio/wav"
+    if data[:4] == b"OggS":
+        return "audio/ogg"
+    return "audio/mpeg"
+
+
+class TTSBackend:
+    """A speech synthesizer. Subclasses implement synthesize(text, language) -> audio bytes."""
+
+    name = "base"
+
+    def available(self) -> bool:
+        return True
+
+    def synthesize(self, text: str, language: str) -> bytes:
+        raise NotImplementedError
+
+
+class GTTSBackend(TTSBackend):
+    """Google Translate TTS (needs network). Returns MP3."""
+
+    name = "gtts"
+
+    def available(self) -> bool:
+        try:
+            import gtts  # noqa: F401
+            return True
+        except ImportError:
+            return False
+
+    def synthesize(self, text: str, language: str) -> bytes:
+        import io
+        from gtts import gTTS
+        # gTTS passes the timeout to its HTTP requests, so a hung call ends on its own.
+        tts = gTTS(text=text, lang=language[:2], slow=False, timeout=TTS_TIMEOUT)
+        audio_buffer = io.BytesIO()
+        tts.write_to_fp(audio_buffer)
+        return audio_buffer.getvalue()
+
+
+# Upper bound on one utterance spoken directly by the local engine.
+LOCAL_SPEAK_TIMEOUT = float(os.environ.get("LOCAL_SPEAK_TIMEOUT", "30"))
+
+
+class PyttsxBackend(TTSBackend):
+    """Offline synthesis on one long-lived pyttsx3 engine (libespeak on Linux). Returns WAV.
+
+    The engine is created once and owned by a dedicated thread, since
+    pyttsx3 engines are not thread-safe; requests are queued to it, so no
+    process is spawned and no engine is initialised per call.
+    """
+
+    name = "pyttsx3"
+
+    def __init__(self):
+        self._requests = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._voices = {}
+        self._broken = False
+        self._started = threading.Event()
+        # tmpfs where available, so the WAV round-trip stays in memory.
+        self._scratch = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+    def available(self) -> bool:
+        """True once the engine has actually initialised (starting it if needed)."""
+        if self._broken or "pyttsx3" not in sys.modules:
+            return False
+        self._start()
+        return self._started.wait(TTS_TIMEOUT) and not self._broken
+
+    def _voice_for(self, engine, language: str) -> Optional[str]:
+        """Engine voice id for a language: the VOICES name if installed, else any voice for that language."""
+        if language in self._voices:
+            return self._voices[language]
+        voices = engine.getProperty("voices") or []
+        preferred = VOICES.get(language)
+        match = next((v.id for v in voices if v.name == preferred), None)
+        if match is None:
+            for voice in voices:
+                codes = []
+                for code in voice.languages or []:
+                    if isinstance(code, bytes):
+                        code = code.decode("utf-8", "ignore").lstrip("\x05")
+                    codes.append(str(code).lower().replace("_", "-").split("-")[0])
+                if language in codes or str(voice.id).lower().rsplit("/", 1)[-1] == language:
+                    match = voice.id
+                    break
+        self._voices[language] = match
+        return match
+
+    def _run(self):
+        import tempfile
+        try:
+            engine = pyttsx3.init()
+            default_voice = engine.getProperty("voice")
+        except Exception as e:
+            print(f"Local TTS engine failed to start: {e}")
+            self._broken = True
+            self._started.set()
+            while True:
+                _, _, _, future = self._requests.get()
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(TTSUnavailable("local TTS engine unavailable"))
+        self._started.set()
+        while True:
+            action, text, language, future = self._requests.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                voice_id = self._voice_for(engine, language) or default_voice
+                if voice_id is not None:
+                    engine.setProperty("voice", voice_id)
+                if action == "say":
+                    engine.say(text)
+                    engine.runAndWait()
+                    future.set_result(None)
+                    continue
+                fd, path = tempfile.mkstemp(suffix=".wav", dir=self._scratch)
+                os.close(fd)
+                try:
+                    engine.save_to_file(text, path)
+                    engine.runAndWait()
+                    with open(path, "rb") as f:
+                        future.set_result(f.read())
+                finally:
+                    os.remove(path)
+            except Exception as e:
+                future.set_exception(e)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="local-tts", daemon=True)
+                self._thread.start()
+
+    def _submit(self, action: str, text: str, language: str) -> concurrent.futures.Future:
+        self._start()
+        future = concurrent.futures.Future()
+        self._requests.put((action, text, language, future))
+        return future
+
+    def synthesize(self, text: str, language: str) -> bytes:
+        future = self._submit("synthesize", text, language)
+        try:
+            return future.result(timeout=TTS_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def speak(self, text: str, language: str, timeout: float = None):
+        """Speak through the engine's own audio output, waiting at most timeout seconds."""
+        future = self._submit("say", text, language)
+        try:
+            future.result(timeout=LOCAL_SPEAK_TIMEOUT if timeout is None else timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+
+class EspeakBackend(TTSBackend):
+    """Offline espeak-ng / espeak synthesizer. Returns WAV."""
+
+    name = "espeak"
+
+    def __init__(self):
+        import shutil
+        self.executable = shutil.which("espeak-ng") or shutil.which("espeak")
+
+    def available(self) -> bool:
+        return self.executable is not None
+
+    def synthesize(self, text: str, language: str) -> bytes:
+        result = subprocess.run(
+            [self.executable, "-v", language[:2], "--stdout", text],
+            capture_output=True, check=True, timeout=TTS_TIMEOUT,
+        )
+        return result.stdout
+
+
+TTS_WORKERS = int(os.environ.get("TTS_WORKERS", "4"))
+TTS_QUEUE_LIMIT = int(os.environ.get("TTS_QUEUE_LIMIT", "32"))
+
+
+class TTSPool:
+    """Fixed-size thread pool for synthesis with a bounded queue.
+
+    submit() returns None instead of queueing when `workers + queue_limit`
+    jobs are already outstanding, so a burst of presses cannot grow the
+    thread count or the backlog without bound.
+    """
+
+    def __init__(self, workers: int = TTS_WORKERS, queue_limit: int = TTS_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts")
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self.counters = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0,
+                         "cancelled": 0, "discarded": 0}
+
+    def _count(self, name: str, delta: int = 1):
+        with self._lock:
+            self.counters[name] += delta
+
+    def submit(self, fn, *args) -> Optional[concurrent.futures.Future]:
+        if not self._slots.acquire(blocking=False):
+            self._count("rejected")
+            return None
+        with self._lock:
+            self.counters["submitted"] += 1
+            self._queued += 1
+
+        def run():
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+            try:
+                result = fn(*args)
+                self._count("completed")
+                return result
+            except Exception:
+                self._count("failed")
+                raise
+            finally:
+                with self._lock:
+                    self._running -= 1
+                self._slots.release()
+
+        future = self._executor.submit(run)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        if future.cancelled():
+            # run() never started, so it could not release its own slot.
+            with self._lock:
+                self._queued -= 1
+                self.counters["cancelled"] += 1
+            self._slots.release()
+
+    def abandon(self, future):
+        """Give up on a job: cancel it if still queued, otherwise discard its result."""
+        if not future.cancel():
+            self._count("discarded")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counters, workers=self.workers, queue_limit=self.queue_limit,
+                        queued=self._queued, running=self._running)
+
+
+_TTS_POOL = TTSPool()
+
+
+class SingleFlight:
+    """Share one in-flight synthesis between concurrent requests for the same clip.
+
+    The first request for a key submits the job ("leader"); requests that
+    arrive while it is running wait on the same future ("coalesced"). A job
+    is only cancelled once every waiter has given up on it.
+    """
+
+    def __init__(self, pool: TTSPool):
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def submit(self, key: str, fn, *args) -> Optional[concurrent.futures.Future]:
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry is not None:
+                entry[1] += 1
+                self.coalesced += 1
+                return entry[0]
+            future = self.pool.submit(fn, *args)
+            if future is None:
+                return None
+            self._inflight[key] = [future, 1]
+            self.leaders += 1
+        # Registered outside the lock: it runs inline if the job already finished.
+        future.add_done_callback(lambda f: self._finish(key, f))
+        return future
+
+    def _finish(self, key: str, future):
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry is not None and entry[0] is future:
+                del self._inflight[key]
+
+    def release(self, key: str, future) -> bool:
+        """Drop one waiter. Returns True if it was the last and the job was abandoned."""
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry is not None and entry[0] is future:
+                entry[1] -= 1
+                if entry[1] > 0:
+                    return False
+        self.pool.abandon(future)
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"leaders": self.leaders, "coalesced": self.coalesced, "inflight": len(self._inflight)}
+
+
+_SINGLE_FLIGHT = SingleFlight(_TTS_POOL)
+
+
+class TTSUnavailable(RuntimeError):
+    """Raised when the synthesis backend is known to be down (circuit open)."""
+
+
+class CircuitBreaker:
+    """Circuit breaker with a latency-adaptive timeout.
+
+    Opens after `failure_threshold` consecutive failures or timeouts, lets a
+    single half-open probe through after `reset_timeout` seconds, and closes
+    again when the probe succeeds. timeout() tracks the p95 of recent
+    successful calls, clamped to [min_timeout, max_timeout].
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0,
+                 min_timeout: float = 1.0, max_timeout: float = TTS_TIMEOUT, window: int = 50):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window)
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def is_open(self) -> bool:
+        """True while calls are being refused and no probe is due yet."""
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def record_success(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._latencies)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def timeout(self) -> float:
+        if len(self._latencies) < 5:
+            return self.max_timeout
+        # Headroom over p95 so normal jitter does not count as a failure.
+        return max(self.min_timeout, min(self.max_timeout, 2 * self.percentile(0.95)))
+
+    def stats(self) -> dict:
+        p95 = self.percentile(0.95)
+        timeout = self.timeout()
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "rejected": self.rejected,
+                "p95_latency": p95,
+                "timeout": timeout,
+            }
+
+
+_TTS_BREAKER = CircuitBreaker()
+
+
+# The first backend is the primary; the first *available* one after it is
+# the local fallback used for hedging and while the primary's circuit is open.
+_LOCAL_ENGINE = PyttsxBackend()
+_TTS_BACKENDS = [GTTSBackend(), _LOCAL_ENGINE, EspeakBackend()]
+
+# Delay before hedging to the fallback until the primary's p90 is known.
+TTS_HEDGE_DELAY = float(os.environ.get("TTS_HEDGE_DELAY", "1.0"))
+_HEDGE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2 * TTS_WORKERS, thread_name_prefix="tts-hedge")
+_hedge_lock = threading.Lock()
+_HEDGE_STATS = {"hedged": 0, "primary_wins": 0, "fallback_wins": 0, "fallback_only": 0}
+
+
+def set_tts_backends(primary: TTSBackend, *fallbacks: TTSBackend):
+    """Replace the synthesis backends, e.g. set_tts_backends(GTTSBackend(), EspeakBackend())."""
+    _TTS_BACKENDS[:] = [primary, *fallbacks]
+
+
+def _fallback_backend() -> Optional[TTSBackend]:
+    for backend in _TTS_BACKENDS[1:]:
+        if backend.available():
+            return backend
+    return None
+
+
+def _count_hedge(name: str):
+    with _hedge_lock:
+        _HEDGE_STATS[name] += 1
+
+
+def tts_stats() -> dict:
+    """Queue depth and outcome counters for the TTS worker pool."""
+    fallback = _fallback_backend()
+    with _hedge_lock:
+        hedge = dict(_HEDGE_STATS)
+    with _splice_lock:
+        splice = dict(_SPLICE_STATS)
+    return dict(_TTS_POOL.stats(), single_flight=_SINGLE_FLIGHT.stats(), breaker=_TTS_BREAKER.stats(),
+                hedge=hedge, splice=splice, primary=_TTS_BACKENDS[0].name, fallback=fallback.name if fallback else None)
+
+
+def _check_tts_available():
+    """Raise TTSUnavailable if no backend could synthesize right now."""
+    if _fallback_backend() is not None:
+        return
+    primary = _TTS_BACKENDS[0]
+    if not primary.available():
+        raise TTSUnavailable(f"{primary.name} is not installed")
+    if _TTS_BREAKER.is_open():
+        raise TTSUnavailable(f"{primary.name} circuit open")
+
+
+def _run_primary(backend: TTSBackend, text: str, language: str) -> bytes:
+    start = time.monotonic()
+    try:
+        data = backend.synthesize(text, language)
+    except Exception:
+        _TTS_BREAKER.record_failure()
+        raise
+    _TTS_BREAKER.record_success(time.monotonic() - start)
+    return data
+
+
+def _synthesize(text: str, language: str):
+    """Synthesize with the primary backend, hedging to the fallback if it is slow.
+
+    If the primary has not answered within its observed p90 latency, the
+    fallback is started in parallel and the first successful result wins.
+    Returns (audio bytes, backend that produced them).
+    """
+    primary = _TTS_BACKENDS[0]
+    fallback = _fallback_backend()
+    if not (primary.available() and _TTS_BREAKER.allow()):
+        if fallback is None:
+            raise TTSUnavailable(f"{primary.name} unavailable")
+        _count_hedge("fallback_only")
+        return fallback.synthesize(text, language), fallback
+    if fallback is None:
+        return _run_primary(primary, text, language), primary
+
+    first = _HEDGE_EXECUTOR.submit(_run_primary, primary, text, language)
+    try:
+        data = first.result(timeout=_TTS_BREAKER.percentile(0.90) or TTS_HEDGE_DELAY)
+        _count_hedge("primary_wins")
+        return data, primary
+    except concurrent.futures.TimeoutError:
+        _count_hedge("hedged")
+    except Exception:
+        pass  # primary failed fast; let the fallback answer
+
+    second = _HEDGE_EXECUTOR.submit(fallback.synthesize, text, language)
+    backends = {first: primary, second: fallback}
+    pending = set(backends)
+    error = None
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if backends[future] is primary:
+                    _count_hedge("primary_wins")
+                else:
+                    _count_hedge("fallback_wins")
+                    # Upgrade the cached clip if the primary still answers later.
+                    first.add_done_callback(
+                        lambda f: f.exception() is None and _AUDIO_CACHE.put(text, language, f.result())
+                    )
+                return future.result(), backends[future]
+            error = future.exception()
+    raise error
+
+
+# ---------------------------------------------------------------------------
+# Templated phrases
+#
+# Custom texts built from a fixed template (help requests, medicine
+# requests) are spoken as separately cached segments and spliced together,
+# so only the novel fill-ins ever need synthesis.
+# ---------------------------------------------------------------------------
+
+HELP_TEMPLATE = "Help needed: {}"
+MEDICINE_TEMPLATE = "Give me {} ({})"
+PHRASE_TEMPLATES = [HELP_TEMPLATE, MEDICINE_TEMPLATE]
+
+_splice_lock = threading.Lock()
+_SPLICE_STATS = {"spliced": 0, "segments_cached": 0, "segments_synthesized": 0, "splice_failed": 0,
+                 "not_spliced": 0}
+_template_patterns = {}
+
+
+def help_phrase(help_text: str) -> str:
+    return HELP_TEMPLATE.format(help_text)
+
+
+def medicine_phrase(medicine: dict) -> str:
+    return MEDICINE_TEMPLATE.format(medicine.get("name", ""), medicine.get("dosage", ""))
+
+
+def template_segments(text: str) -> Optional[list]:
+    """Split text into its speakable template parts and fill-ins, or None if it matches no template."""
+    for template in PHRASE_TEMPLATES:
+        pattern = _template_patterns.get(template)
+        if pattern is None:
+            fixed = template.split("{}")
+            pattern = re.compile("^" + "(.+?)".join(re.escape(part) for part in fixed) + "$", re.S)
+            _template_patterns[template] = (pattern, fixed)
+        else:
+            pattern, fixed = pattern
+        match = pattern.match(text)
+        if not match:
+            continue
+        parts = []
+        for index, part in enumerate(fixed):
+            parts.append(part)
+            if index < len(match.groups()):
+                parts.append(match.group(index + 1))
+        # Punctuation-only pieces such as " (" carry no speech.
+        return [part.strip() for part in parts if any(ch.isalnum() for ch in part)]
+    return None
+
+
+def _concat_wav(clips: list) -> Optional[bytes]:
+    import io
+    import wave
+    out = io.BytesIO()
+    with wave.open(out, "wb") as writer:
+        params = None
+        for clip in clips:
+            with wave.open(io.BytesIO(clip), "rb") as reader:
+                if params is None:
+                    params = reader.getparams()
+                    writer.setparams(params)
+                elif reader.getparams()[:3] != params[:3]:
+                    return None
+                writer.writeframes(reader.readframes(reader.getnframes()))
+    return out.getvalue()
+
+
+def _pydub_format(data: bytes) -> str:
+    # An explicit format lets pydub read WAV natively instead of probing with ffmpeg.
+    return {"audio/wav": "wav", "audio/ogg": "ogg"}.get(audio_mime(data), "mp3")
+
+
+def splice_audio(clips: list) -> Optional[bytes]:
+    """Concatenate clips into one. Returns None if their formats cannot be joined."""
+    mimes = {audio_mime(clip) for clip in clips}
+    try:
+        from pydub import AudioSegment
+        import io
+        combined = sum((AudioSegment.from_file(io.BytesIO(clip), format=_pydub_format(clip)) for clip in clips[1:]),
+                       AudioSegment.from_file(io.BytesIO(clips[0]), format=_pydub_format(clips[0])))
+        out = io.BytesIO()
+        combined.export(out, format="mp3" if "audio/mpeg" in mimes else "wav")
+        return out.getvalue()
+    except Exception:
+        pass  # pydub/ffmpeg missing; fall back to format-native joining
+    if mimes == {"audio/mpeg"}:
+        # MP3 is a sequence of self-contained frames, so clips join byte-wise.
+        return b"".join(clips)
+    if mimes == {"audio/wav"}:
+        try:
+            return _concat_wav(clips)
+        except Exception:
+            return None
+    return None
+
+
+def _splice_template(text: str, language: str) -> Optional[bytes]:
+    segments = template_segments(text)
+    if not segments:
+        return None
+    cached = [_AUDIO_CACHE.get(segment, language) for segment in segments]
+    missing = [segment for segment, clip in zip(segments, cached) if clip is None]
+    if len(missing) > 1:
+        # Several segments in a row would not fit in one synthesis timeout:
+        # speak the whole text now and cache the segments in the background.
+        with _splice_lock:
+            _SPLICE_STATS["not_spliced"] += 1
+        warm_audio_cache([(segment, language) for segment in missing])
+        return None
+    clips = []
+    for segment, clip in zip(segments, cached):
+        if clip is None:
+            clip, backend = _synthesize(segment, language)
+            _AUDIO_CACHE.put(segment, language, clip, persist=backend is _TTS_BACKENDS[0])
+            stat = "segments_synthesized"
+        else:
+            stat = "segments_cached"
+        with _splice_lock:
+            _SPLICE_STATS[stat] += 1
+        clips.append(clip)
+    data = splice_audio(clips)
+    with _splice_lock:
+        _SPLICE_STATS["spliced" if data else "splice_failed"] += 1
+    return data
+
+
+def _synthesize_and_cache(text: str, language: str) -> bytes:
+    data = _splice_template(text, language)
+    if data is not None:
+        # Segments are persisted individually; the joined clip only lives in memory.
+        _AUDIO_CACHE.put(text, language, data, persist=False)
+        return data
+    data, backend = _synthesize(text, language)
+    # A result that arrives after the caller's timeout still fills the cache.
+    # Fallback audio stays in memory only, so the primary voice returns after a restart.
+    _AUDIO_CACHE.put(text, language, data, persist=backend is _TTS_BACKENDS[0])
+    return data
+
+
+def get_audio(text: str, language: str = "en", timeout: float = None) -> Optional[bytes]:
+    """Return speech audio for text, from the audio cache or a fresh synthesis.
+
+    Raises TTSUnavailable when synthesis cannot be attempted, so callers can
+    fall back to local speech straight away.
+    """
+    audio_bytes = _AUDIO_CACHE.get(text, language)
+    if audio_bytes is not None:
+        return audio_bytes
+
+    _check_tts_available()
+    if timeout is None:
+        timeout = _TTS_BREAKER.timeout()
+
+    clip_id = audio_id(text, language)
+    future = _SINGLE_FLIGHT.submit(clip_id, _synthesize_and_cache, text, language)
+    if future is None:
+        print("TTS queue full, continuing without audio")
+        return None
+    try:
+        return future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        # The breaker hears about a hung call from _run_primary once gTTS's own timeout fires.
+        _SINGLE_FLIGHT.release(clip_id, future)
+        print("Audio generation timed out, continuing without audio")
+    except Exception as e:
+        print(f"TTS error: {e}")
+    return None
+
+
+_warmup_lock = threading.Lock()
+_warmup_queue = queue.Queue()
+_warmup_thread = None
+_WARMUP_STATUS = {"state": "idle", "total": 0, "done": 0, "cached": 0, "failed": 0}
+
+
+def config_phrases(config: dict = None) -> list:
+    """All distinct (text, language) pairs spoken by the configured buttons."""
+    config = CONFIG if config is None else config
+    phrases = []
+    for button in config.values():
+        for language, text in button.get("texts", {}).items():
+            if text and (text, language) not in phrases:
+                phrases.append((text, language))
+    return phrases
+
+
+def _warmup_worker():
+    global _warmup_thread
+    while True:
+        try:
+            text, language = _warmup_queue.get(timeout=0.5)
+        except queue.Empty:
+            with _warmup_lock:
+                if _warmup_queue.empty():
+                    _WARMUP_STATUS["state"] = "done"
+                    _warmup_thread = None
+                    return
+            continue
+        outcome = "cached"
+        if _AUDIO_CACHE.get(text, language) is None:
+            try:
+                _synthesize_and_cache(text, language)
+                outcome = "done"
+            except Exception as e:
+                print(f"Warm-up error for {language}: {e}")
+                outcome = "failed"
+        with _warmup_lock:
+            _WARMUP_STATUS[outcome] += 1
+
+
+def warm_audio_cache(phrases: list = None):
+    """Synthesize or load clips into the audio cache in the background.
+
+    With no arguments every CONFIG phrase is warmed; pass (text, language)
+    pairs to re-warm only entries that changed. Progress is reported by
+    warmup_status().
+    """
+    global _warmup_thread
+    phrases = config_phrases() if phrases is None else phrases
+    with _warmup_lock:
+        for phrase in phrases:
+            _warmup_queue.put(phrase)
+        _WARMUP_STATUS["total"] += len(phrases)
+        if _warmup_thread is None and phrases:
+            _WARMUP_STATUS["state"] = "running"
+            _warmup_thread = threading.Thread(target=_warmup_worker, name="audio-warmup", daemon=True)
+            _warmup_thread.start()
+
+
+def _warm_config_changes(old_version: int, new_version: int):
+    phrases = _CONFIG_STORE.changed_phrases(old_version, new_version)
+    if phrases is None or phrases:
+        warm_audio_cache(phrases)
+
+
+subscribe_config(_warm_config_changes)
+
+
+def warmup_status() -> dict:
+    """Progress of the audio warm-up: total queued, synthesized, already cached, failed."""
+    with _warmup_lock:
+        status = dict(_WARMUP_STATUS)
+    status["pending"] = status["total"] - status["done"] - status["cached"] - status["failed"]
+    return status
+
+
+def _player_command(is_wav: bool) -> Optional[list]:
+    """Command line of a local player for MP3 or WAV clips, or None if none is installed."""
+    import shutil
+    if platform.system() == "Darwin":
+        return ["afplay"]
+    if is_wav and shutil.which("aplay"):
+        return ["aplay", "-q"]
+    if not is_wav and shutil.which("mpg123"):
+        return ["mpg123", "-q"]
+    if shutil.which("ffplay"):
+        return ["ffplay", "-nodisp", "-autoexit", "-loglevel", "quiet"]
+    return None
+
+
+PRIORITY_EMERGENCY = 0
+PRIORITY_NORMAL = 10
+PLAYBACK_PRIORITIES = {"BTN6": PRIORITY_EMERGENCY}
+
+
+class PlaybackDaemon:
+    """Local speech playback on a background thread, fed by a priority queue.
+
+    Clips come from the audio cache (or the offline engine) and are played
+    through an external player process, so a higher-priority item can
+    pre-empt the current one by terminating that process. An item that is
+    still being synthesized when a higher-priority one arrives is dropped
+    before it starts playing.
+    """
+
+    def __init__(self):
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._process = None
+        self._current_priority = None
+        self._latencies = collections.deque(maxlen=100)
+        self.played = 0
+        self.preempted = 0
+        self.failed = 0
+
+    def enqueue(self, text: str, language: str, priority: int = PRIORITY_NORMAL):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="playback", daemon=True)
+                self._thread.start()
+            self._queue.put((priority, next(self._seq), time.monotonic(), text, language))
+            if self._process is not None and priority < self._current_priority:
+                self._process.terminate()
+
+    def _run(self):
+        while True:
+            priority, _, enqueued_at, text, language = self._queue.get()
+            with self._lock:
+                self._latencies.append(time.monotonic() - enqueued_at)
+                self._current_priority = priority
+            try:
+                if self._speak(text, language, priority):
+                    self.played += 1
+                else:
+                    with self._lock:
+                        self.preempted += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"TTS Error: {str(e)}")
+            finally:
+                with self._lock:
+                    self._process = None
+                    self._current_priority = None
+
+    def _outranked(self, priority: int) -> bool:
+        """True if a higher-priority item is waiting in the queue."""
+        with self._queue.mutex:
+            return bool(self._queue.queue) and self._queue.queue[0][0] < priority
+
+    def _play(self, command: list, priority: int) -> bool:
+        # Checked under the same lock enqueue() takes, so an urgent item
+        # arriving now either stops us here or terminates the process.
+        with self._lock:
+            if self._outranked(priority):
+                return False
+            self._process = subprocess.Popen(command)
+            process = self._process
+        # A negative return code means enqueue() terminated the player.
+        return process.wait() >= 0
+
+    def _speak(self, text: str, language: str, priority: int) -> bool:
+        """Play one item; False if it was skipped for a higher-priority one."""
+        import tempfile
+        data = _AUDIO_CACHE.get(text, language)
+        if data is None and platform.system() != "Darwin" and _LOCAL_ENGINE.available():
+            data = _LOCAL_ENGINE.synthesize(text, language)
+            _AUDIO_CACHE.put(text, language, data, persist=False)
+        if data is not None:
+            is_wav = audio_mime(data) == "audio/wav"
+            command = _player_command(is_wav)
+            if command is not None:
+                with tempfile.NamedTemporaryFile(suffix=".wav" if is_wav else ".mp3", delete=False) as f:
+                    f.write(data)
+                try:
+                    return self._play(command + [f.name], priority)
+                finally:
+                    os.remove(f.name)
+        if platform.system() == "Darwin":
+            return self._play(["say", "-v", VOICES.get(language, "Samantha"), text], priority)
+        if self._outranked(priority):
+            return False
+        if _LOCAL_ENGINE.available():
+            # No external player: the engine speaks itself, which cannot be pre-empted.
+            _LOCAL_ENGINE.speak(text, language)
+        else:
+            print(f"TTS not supported on this platform. Text: {text}")
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                "queue_depth": self._queue.qsize(),
+                "playing": self._current_priority is not None,
+                "played": self.played,
+                "preempted": self.preempted,
+                "failed": self.failed,
+                "avg_start_latency": sum(latencies) / len(latencies) if latencies else None,
+                "p95_start_latency": latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+            }
+
+
+_PLAYBACK = PlaybackDaemon()
+
+
+def playback_stats() -> dict:
+    """Queue depth and start latency of local playback."""
+    return _PLAYBACK.stats()
+
+
+EVENT_AUDIO_LIMIT = int(os.environ.get("EVENT_AUDIO_LIMIT", "10000"))
+
+_event_audio_lock = threading.Lock()
+_EVENT_AUDIO = collections.OrderedDict()
+_AUDIO_SUBSCRIBERS = []
+
+
+def subscribe_audio(callback):
+    """Call callback(event_id, audio_id, status) whenever an event's audio is ready or has failed."""
+    _AUDIO_SUBSCRIBERS.append(callback)
+
+
+def unsubscribe_audio(callback):
+    if callback in _AUDIO_SUBSCRIBERS:
+        _AUDIO_SUBSCRIBERS.remove(callback)
+
+
+def _set_event_audio(event_id: str, clip_id: str, status: str):
+    with _event_audio_lock:
+        _EVENT_AUDIO[event_id] = {"audio_id": clip_id, "status": status}
+        _EVENT_AUDIO.move_to_end(event_id)
+        while len(_EVENT_AUDIO) > EVENT_AUDIO_LIMIT:
+            _EVENT_AUDIO.popitem(last=False)
+    if status == "pending":
+        return
+    for callback in list(_AUDIO_SUBSCRIBERS):
+        try:
+            callback(event_id, clip_id, status)
+        except Exception as e:
+            print(f"Audio subscriber error: {e}")
+
+
+def _start_event_audio(event_id: str, text: str, language: str):
+    """Kick off background synthesis for an event. Returns (cached audio or None, status)."""
+    clip_id = audio_id(text, language)
+    audio_bytes = _AUDIO_CACHE.get_by_id(clip_id)
+    if audio_bytes is not None:
+        _set_event_audio(event_id, clip_id, "ready")
+        return audio_bytes, "ready"
+    try:
+        _check_tts_available()
+    except TTSUnavailable as e:
+        print(f"Audio generation error: {e}")
+        _set_event_audio(event_id, clip_id, "failed")
+        return None, "failed"
+    # Background waiters never release, so their job is never cancelled.
+    future = _SINGLE_FLIGHT.submit(clip_id, _synthesize_and_cache, text, language)
+    if future is None:
+        print("TTS queue full, continuing without audio")
+        _set_event_audio(event_id, clip_id, "failed")
+        return None, "failed"
+    _set_event_audio(event_id, clip_id, "pending")
+
+    def done(f):
+        failed = f.cancelled() or f.exception() is not None
+        _set_event_audio(event_id, clip_id, "failed" if failed else "ready")
+
+    future.add_done_callback(done)
+    return None, "pending"
+
+
+def event_audio(event_id: str):
+    """Return (status, audio_id or None) for an event; status is ready, pending, failed or unknown."""
+    with _event_audio_lock:
+        entry = _EVENT_AUDIO.get(event_id)
+    if entry is None:
+        return "unknown", None
+    if entry["status"] != "ready":
+        return entry["status"], None
+    if _AUDIO_CACHE.get_by_id(entry["audio_id"]) is None:
+        return "unknown", None
+    return "ready", entry["audio_id"]
+
+
+_EVENT_SUBSCRIBERS = []
+
+
+def subscribe_events(callback):
+    """Call callback(event) for every new event once it has been stored."""
+    _EVENT_SUBSCRIBERS.append(callback)
+
+
+def unsubscribe_events(callback):
+    if callback in _EVENT_SUBSCRIBERS:
+        _EVENT_SUBSCRIBERS.remove(callback)
+
+
+def _publish_events(events: list):
+    """Add stored events to HISTORY and notify subscribers."""
+    for event in events:
+        HISTORY.append(event)
+    for callback in list(_EVENT_SUBSCRIBERS):
+        for event in events:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"Event subscriber error: {e}")
+
+
+EVENT_WRITE_BATCH = int(os.environ.get("EVENT_WRITE_BATCH", "256"))
+EVENT_WRITE_QUEUE = int(os.environ.get("EVENT_WRITE_QUEUE", "10000"))
+EVENT_WRITE_TIMEOUT = float(os.environ.get("EVENT_WRITE_TIMEOUT", "30"))
+
+
+class EventWriter:
+    """Group commit for new events.
+
+    Events from every caller are queued to one writer thread, which drains
+    whatever has accumulated (up to max_batch events) into a single storage
+    transaction and then resolves each caller's future. Under load this
+    turns one fsync per press into one per batch.
+    """
+
+    def __init__(self, max_batch: int = EVENT_WRITE_BATCH, queue_limit: int = EVENT_WRITE_QUEUE):
+        self.max_batch = max_batch
+        self._queue = queue.Queue(maxsize=queue_limit)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.counters = {"events": 0, "batches": 0, "rejected": 0, "failed": 0}
+
+    def submit(self, events: list) -> Optional[concurrent.futures.Future]:
+        """Queue events for writing; None if the queue is full."""
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="event-writer", daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait((events, future))
+        except queue.Full:
+            with self._lock:
+                self.counters["rejected"] += 1
+            return None
+        return future
+
+    def write(self, events: list):
+        """Write events and block until they are stored."""
+        future = self.submit(events)
+        if future is None:
+            # Queue full: write directly rather than drop the event.
+            _storage().append_events(events)
+            _publish_events(events)
+            return
+        future.result(timeout=EVENT_WRITE_TIMEOUT)
+
+    @staticmethod
+    def _resolve(future: concurrent.futures.Future, error: Exception = None):
+        # A waiter may have given up (e.g. a cancelled request); its events are written anyway.
+        try:
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+        except concurrent.futures.InvalidStateError:
+            pass
+
+    def _run(self):
+        while True:
+            try:
+                self._write_batch()
+            except Exception as e:
+                print(f"Event writer error: {e}")
+
+    def _write_batch(self):
+        items = [self._queue.get()]
+        size = len(items[0][0])
+        while size < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            items.append(item)
+            size += len(item[0])
+        events = [event for batch, _ in items for event in batch]
+        try:
+            _storage().append_events(events)
+        except Exception as e:
+            print(f"Event write error: {e}")
+            with self._lock:
+                self.counters["failed"] += len(events)
+            for _, future in items:
+                self._resolve(future, e)
+            return
+        try:
+            _publish_events(events)
+        finally:
+            with self._lock:
+                self.counters["events"] += len(events)
+                self.counters["batches"] += 1
+            for _, future in items:
+                self._resolve(future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+        stats["queued"] = self._queue.qsize()
+        stats["avg_batch"] = stats["events"] / stats["batches"] if stats["batches"] else None
+        return stats
+
+
+_EVENT_WRITER = EventWriter()
+
+
+def event_writer_stats() -> dict:
+    """Group-commit counters for event persistence."""
+    return _EVENT_WRITER.stats()
+
+
+def build_event(button: str, language: str = "en", source: str = "UI", custom_text: str = None,
+                device_id: str = "unknown", user_id: str = "default", timestamp: str = None) -> dict:
+    """Resolve the spoken text and build a new event record (not yet stored)."""
+    import datetime
+    text = custom_text or get_config(user_id).get(button, {}).get("texts", {}).get(language, "Button pressed")
+    return {
+        "event_id": uuid.uuid4().hex,
+        "button": button,
+        "language": language,
+        "text": text,
+        "source": source,
+        "device_id": device_id,
+        "user_id": user_id,
+        "timestamp": timestamp or datetime.datetime.now().isoformat(),
+        "audio": None,
+    }
+
+
+BATCH_MAX_PRESSES = int(os.environ.get("BATCH_MAX_PRESSES", "500"))
+DEVICE_SEQ_LIMIT = int(os.environ.get("DEVICE_SEQ_LIMIT", "10000"))
+
+
+class SequenceTracker:
+    """Highest stored press sequence number per (device, boot).
+
+    Devices number presses from 1 after every boot, so a batch re-sent after
+    a lost response is recognised by its sequence numbers and not stored
+    twice. Claims are made before writing and rolled back if the write fails.
+    A key not seen by this process (after a restart, or once trimmed) starts
+    from the highest seq in the event store rather than from 0.
+    """
+
+    def __init__(self, limit: int = DEVICE_SEQ_LIMIT):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._last = collections.OrderedDict()
+
+    def claim(self, key, seqs: list, stored=None) -> tuple:
+        """Return (previous high-water mark, sorted seqs above it); the mark moves to the highest claimed.
+
+        stored() returns the mark to start from for a key this process has not seen.
+        """
+        if stored is not None:
+            with self._lock:
+                known = key in self._last
+            if not known:
+                highest = stored()
+                with self._lock:
+                    self._last.setdefault(key, highest)
+        with self._lock:
+            last = self._last.get(key, 0)
+            # Sorted, so a batch that arrives out of order is not mistaken for duplicates.
+            fresh = [seq for seq in sorted(set(seqs)) if seq > last]
+            if fresh:
+                self._last[key] = fresh[-1]
+                self._last.move_to_end(key)
+                while len(self._last) > self.limit:
+                    self._last.popitem(last=False)
+            return last, fresh
+
+    def release(self, key, previous: int, claimed: int):
+        """Undo a claim after a failed write, unless a later batch moved the mark on."""
+        with self._lock:
+            if self._last.get(key) == claimed:
+                self._last[key] = previous
+
+
+_DEVICE_SEQ = SequenceTracker()
+
+
+def prepare_batch(presses: list, device_id: str, user_id: str, boot_id: str = "",
+                  source: str = "DEVICE"):
+    """Build events for a batch of buffered presses.
+
+    Each press is a dict with seq, button and optionally language,
+    custom_text and either timestamp (ISO) or age_ms (how long before the
+    request it was pressed, for devices without a clock). Returns
+    (events, results, claim): results has one entry per press, in order,
+    and claim must be passed to release_batch() if storing the events fails.
+    """
+    import datetime
+    now = datetime.datetime.now()
+    key = (device_id, boot_id)
+    seqs = [press.get("seq", 0) for press in presses]
+    previous, fresh = _DEVICE_SEQ.claim(key, [seq for seq in seqs if seq >= 1],
+                                        lambda: _storage().max_seq(device_id, boot_id))
+    claimed = fresh[-1] if fresh else None
+    fresh = set(fresh)
+    events, results = [], []
+    for press, seq in zip(presses, seqs):
+        result = {"seq": seq}
+        results.append(result)
+        if seq < 1:
+            result.update(ok=False, status="invalid", error="seq must be 1 or more")
+            continue
+        if seq not in fresh:
+            result.update(ok=True, status="duplicate")
+            continue
+        fresh.discard(seq)
+        timestamp = press.get("timestamp")
+        try:
+            if timestamp:
+                datetime.datetime.fromisoformat(timestamp)
+            elif press.get("age_ms") is not None:
+                timestamp = (now - datetime.timedelta(milliseconds=max(press["age_ms"], 0))).isoformat()
+        except (TypeError, ValueError):
+            result.update(ok=False, status="invalid", error="bad timestamp")
+            continue
+        if not press.get("button"):
+            result.update(ok=False, status="invalid", error="missing button")
+            continue
+        event = build_event(press["button"], press.get("language") or "en", source,
+                            press.get("custom_text"), device_id, user_id, timestamp)
+        event["seq"] = seq
+        event["boot_id"] = boot_id
+        events.append(event)
+        result.update(ok=True, status="stored", event_id=event["event_id"])
+    events.sort(key=lambda event: event["seq"])
+    return events, results, (key, previous, claimed)
+
+
+def release_batch(claim):
+    """Forget the sequence numbers claimed by prepare_batch() so the device can retry."""
+    key, previous, claimed = claim
+    if claimed is not None:
+        _DEVICE_SEQ.release(key, previous, claimed)
+
+
+def submit_events(events: list) -> Optional[concurrent.futures.Future]:
+    """Queue events for group commit. Resolves once stored and published; None if the writer is full."""
+    return _EVENT_WRITER.submit(events)
+
+
+def event_audio_now(event: dict):
+    """Synthesize an event's audio, blocking. Returns (audio bytes or None, status)."""
+    text, language = event["text"], event["language"]
+    try:
+        audio_bytes = get_audio(text, language)
+    except Exception as e:
+        print(f"Audio generation error: {e}")
+        audio_bytes = None
+        # Fallback: Try to use local TTS
+        try:
+            speak_text(text, language, PLAYBACK_PRIORITIES.get(event["button"], PRIORITY_NORMAL))
+        except:
+            pass
+    audio_status = "ready" if audio_bytes else "failed"
+    _set_event_audio(event["event_id"], audio_id(text, language), audio_status)
+    return audio_bytes, audio_status
+
+
+def event_audio_later(event: dict):
+    """Start background synthesis for an event. Returns (cached audio or None, status)."""
+    return _start_event_audio(event["event_id"], event["text"], event["language"])
+
+
+def event_result(event: dict, audio_bytes: Optional[bytes], audio_status: str) -> dict:
+    """The trigger() return value for a stored event."""
+    return {
+        "event_id": event["event_id"],
+        "button": event["button"],
+        "text": event["text"],
+        "language": event["language"],
+        "audio": audio_bytes,
+        "audio_id": audio_id(event["text"], event["language"]),
+        "audio_status": audio_status,
+        "timestamp": event["timestamp"],
+    }
+
+
+def trigger(button: str, language: str = "en", source: str = "UI", custom_text: str = None, 
+            device_id: str = "unknown", user_id: str = "default", wait_for_audio: bool = True) -> dict:
+    """Trigger an event and generate audio.
+
+    With wait_for_audio=False the event is persisted and returned at once and
+    the audio is synthesized in the background; fetch it later with
+    event_audio(event_id) or subscribe_audio().
+    """
+    event = build_event(button, language, source, custom_text, device_id, user_id)
+    _EVENT_WRITER.write([event])
+    if wait_for_audio:
+        audio_bytes, audio_status = event_audio_now(event)
+    else:
+        audio_bytes, audio_status = event_audio_later(event)
+    return event_result(event, audio_bytes, audio_status)
+
+
+def add_caretaker(primary_email: str, caretaker_email: str) -> bool:
+    """Add a caretaker relationship between a primary user and a caretaker."""
+    primary_key = primary_email.lower()
+    caretaker_key = caretaker_email.lower()
+    primary = _storage().get_user(primary_key)
+    
+    if primary is None or _storage().get_user(caretaker_key) is None:
+        raise ValueError("One or both users not found")
+    
+    if "caretakers" not in primary:
+        primary["caretakers"] = []
+    
+    if caretaker_key not in primary["caretakers"]:
+        primary["caretakers"].append(caretaker_key)
+    
+    _storage().put_user(primary_key, primary)
+    return True
+
+
+def remove_caretaker(primary_email: str, caretaker_email: str) -> bool:
+    """Remove a caretaker relationship. Returns False if it did not exist."""
+    primary_key = primary_email.lower()
+    caretaker_key = caretaker_email.lower()
+    primary = _storage().get_user(primary_key)
+    
+    if primary is None:
+        raise ValueError("User not found")
+    
+    if caretaker_key not in primary.get("caretakers", []):
+        return False
+    
+    primary["caretakers"].remove(caretaker_key)
+    _storage().put_user(primary_key, primary)
+    return True
+
+
+def get_primaries_for_caretakers(emails: list) -> dict:
+    """Get the accessible accounts for many caretakers at once, keyed by caretaker email."""
+    keys = [email.lower() for email in emails]
+    primaries = _USER_CACHE.primaries_for(keys)
+    result = {}
+    for key in keys:
+        accounts = []
+        for primary_key in primaries.get(key, []):
+            user_data = get_user_by_email(primary_key)
+            if user_data:
+                accounts.append({
+                    "email": user_data.get("email"),
+                    "full_name": user_data.get("full_name"),
+                })
+        result[key] = accounts
+    return result
+
+
+def get_accessible_accounts(email: str) -> list:
+    """Get list of accounts that this user can access (for caretakers)."""
+    return get_primaries_for_caretakers([email])[email.lower()]
+
+
+def get_user_profile(email: str) -> Optional[dict]:
+    """Get user profile information."""
+    user = get_user_by_email(email)
+    if not user:
+        return None
+    
+   
+    return {
+        "full_name": user.get("full_name"),
+        "email": user.get("email"),
+        "phone": user.get("phone"),
+        "account_type": user.get("account_type"),
+    }
+
+
+def set_user_theme(email: str, theme: str) -> bool:
+    """Set user theme preference."""
+    user_key = email.lower()
+    user = _storage().get_user(user_key)
+    
+    if user is None:
+        raise ValueError("User not found")
+    
+    user["theme"] = theme
+    _storage().put_user(user_key, user)
+    return True
+
+
+def get_user_medicines(email: str) -> list:
+    """Get list of medicines for a user."""
+    user = get_user_by_email(email)
+    if not user:
+        return []
+    
+    return user.get("medicines", [])
+
+
+def set_user_medicines(email: str, medicines: list) -> bool:
+    """Set medicines for a user."""
+    user_key = email.lower()
+    user = _storage().get_user(user_key)
+    
+    if user is None:
+        raise ValueError("User not found")
+    
+    old_medicines = user.get("medicines", [])
+    user["medicines"] = medicines
+    _storage().put_user(user_key, user)
+    _refresh_medicine_audio(user_key, user, old_medicines, medicines)
+    return True
+
+
+def _user_languages(user_key: str, user: dict) -> list:
+    """Languages to prepare audio in: the user's saved list, else what they have recently pressed in."""
+    languages = user.get("languages") or []
+    if not languages:
+        for event in reversed(HISTORY.tail(50, user_id=user_key)):
+            if event.get("language") and event["language"] not in languages:
+                languages.append(event["language"])
+    return languages or ["en"]
+
+
+def _refresh_medicine_audio(user_key: str, user: dict, old_medicines: list, medicines: list):
+    """Queue medicine request phrases for background synthesis and drop clips for removed medicines."""
+    languages = _user_languages(user_key, user)
+    current = {medicine_phrase(medicine) for medicine in medicines}
+    removed = [medicine for medicine in old_medicines if medicine_phrase(medicine) not in current]
+    if removed:
+        # Clips are shared by content, so keep any that another user's list still speaks.
+        in_use = set()
+        for other in _storage().all_users().values():
+            for medicine in other.get("medicines", []):
+                in_use.add(medicine_phrase(medicine))
+                in_use.add(medicine.get("name", "").strip())
+        in_use.update(current)
+        in_use.update(medicine.get("name", "").strip() for medicine in medicines)
+    for medicine in removed:
+        phrase = medicine_phrase(medicine)
+        name = medicine.get("name", "").strip()
+        for language in languages:
+            if phrase not in in_use:
+                _AUDIO_CACHE.evict(phrase, language)
+            # Dosage clips like "500mg" are shared between medicines, so only the name goes.
+            if name and name not in in_use:
+                _AUDIO_CACHE.evict(name, language)
+    warm_audio_cache([(phrase, language) for phrase in current for language in languages])
 
-def set_user_medicines(email: str, medicines: list) -> bool:
-    """Set medicines for a user."""
-    users = _load_users()
-    user_key = email.lower()
-    
-    if user_key not in users:
-        raise ValueError("User not found")
-    
-    users[user_key]["medicines"] = medicines
-    _save_users(users)
-    return True
 
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Assistive Buttons maintenance tasks")
+    parser.add_argument("command", choices=["build-bundle"])
+    parser.add_argument("--output", default=AUDIO_BUNDLE_FILE)
+    args = parser.parse_args()
+    if args.command == "build-bundle":
+        print(json.dumps(build_audio_bundle(args.output), indent=2, ensure_ascii=False))
@@ -0,0 +1,40 @@
+import importlib.util
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def shared():
+    spec = importlib.util.spec_from_file_location("shared", os.path.join(ROOT, "commit 7 shared.py"))
+    module = importlib.util.module_from_spec(spec)
+    # The module imports pyttsx3 at the top; nothing here speaks, so a bare stand-in will do.
+    try:
+        import pyttsx3  # noqa: F401
+    except ImportError:
+        sys.modules["pyttsx3"] = types.ModuleType("pyttsx3")
+    sys.modules["shared"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def storage(request, shared, tmp_path, monkeypatch):
+    """A fresh storage backend of each kind, with every data file under tmp_path."""
+    for name, filename in [("USERS_FILE", "users.json"), ("DEVICES_FILE", "devices.json"),
+                           ("CONFIG_FILE", "config.json"), ("EVENTS_FILE", "events.json"),
+                           ("EVENTS_LOG_FILE", "events.jsonl")]:
+        monkeypatch.setattr(shared, name, str(tmp_path / filename))
+    monkeypatch.setattr(shared, "_events_fp", None)
+    if request.param == "sqlite":
+        backend = shared.SqliteStorage(str(tmp_path / "assistive.db"))
+    else:
+        backend = shared.JsonStorage()
+    monkeypatch.setattr(shared, "_STORAGE", backend)
+    yield backend
+    if shared._events_fp is not None:
+        shared._events_fp.close()
@@ -0,0 +1,82 @@
+import copy
+import threading
+
+DEFAULTS = {
+    "BTN1": {"label": "Water", "texts": {"en": "I need water", "hi": "Mujhe paani chahiye"}},
+    "BTN2": {"label": "Food", "texts": {"en": "I am hungry"}},
+}
+
+
+def make_store(shared):
+    return shared.ConfigStore(copy.deepcopy(DEFAULTS), reload_interval=0)
+
+
+def test_racing_writers_lose_no_edits(shared, storage):
+    # Separate stores share nothing but storage, like two server processes.
+    stores = [make_store(shared), make_store(shared)]
+    edits = 25
+    applied = []
+
+    def write(index):
+        for n in range(edits):
+            while True:
+                try:
+                    stores[index].update({f"W{index}-{n}": {"label": str(n)}}, user_id=f"user{index}")
+                    break
+                except RuntimeError:
+                    continue  # outraced three times in a row; try again
+        applied.append(index)
+
+    threads = [threading.Thread(target=write, args=(index,)) for index in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    doc = storage.load_config()
+    assert sorted(applied) == [0, 1]
+    assert doc["version"] == 2 * edits
+    for index in range(2):
+        assert set(doc["users"][f"user{index}"]) == {f"W{index}-{n}" for n in range(edits)}
+
+
+def test_override_removed_through_none(shared, storage):
+    store = make_store(shared)
+    first = store.update({"BTN1": {"label": "Drink", "texts": {"en": "Water, please"}}}, user_id="u")
+    assert store.view("u")[2]["BTN1"] == {"label": "Drink",
+                                          "texts": {"en": "Water, please", "hi": "Mujhe paani chahiye"}}
+    assert store.view()[2] == DEFAULTS
+
+    store.update({"BTN1": {"label": None, "texts": {"en": None}}}, user_id="u")
+    assert store.view("u")[2] == DEFAULTS
+    assert "u" not in store.refresh()["users"]
+    assert store.delta(first, "u") == {"BTN1": {"label": "Water", "texts": {"en": "I need water"}}}
+
+    removed = store.update({"BTN2": None})
+    assert "BTN2" not in store.view("u")[2]
+    assert store.delta(removed - 1) == {"BTN2": None}
+    assert store.delta(removed) == {}
+
+
+def test_delta_rebuilds_the_current_config(shared, storage):
+    store = make_store(shared)
+    base = store.update({"BTN3": {"label": "Help", "texts": {"en": "Help me"}}})
+    old = copy.deepcopy(store.view("u")[2])
+    store.update({"BTN1": {"texts": {"fr": "J'ai soif"}}}, user_id="u")
+    store.update({"BTN3": {"texts": {"en": None, "de": "Hilfe"}}, "BTN2": {"label": "Meal"}})
+
+    shared._apply_config_changes(old, store.delta(base, "u"))
+    assert old == store.view("u")[2]
+
+
+def test_same_version_replacement_is_reloaded(shared, storage):
+    store = make_store(shared)
+    version = store.update({"BTN1": {"label": "Drink"}})
+    assert store.view()[2]["BTN1"]["label"] == "Drink"
+
+    # Another writer replaces the document without bumping the version.
+    doc = copy.deepcopy(storage.load_config())
+    doc["base"]["BTN1"]["label"] = "Thirsty"
+    assert storage.save_config(doc, version)
+    store.refresh()
+    assert store.view()[2]["BTN1"]["label"] == "Thirsty"
@@ -0,0 +1,92 @@
+import itertools
+
+import pytest
+
+
+def make_events(sizes):
+    events = []
+    for index, size in enumerate(sizes):
+        events.append({
+            "event_id": f"e{index}",
+            "button": f"BTN{index % 3 + 1}",
+            "language": "en",
+            "text": "x" * size,
+            "source": "UI",
+            "device_id": "d1",
+            "user_id": "a" if index % 2 else "b",
+            "timestamp": f"2024-01-01T00:{index // 60:02d}:{index % 60:02d}",
+        })
+    return events
+
+
+def read_pages(shared, limit, **filters):
+    ids, cursor = [], None
+    while True:
+        page, cursor = shared.query_events(limit=limit, cursor=cursor, **filters)
+        ids.extend(event["event_id"] for event in page)
+        if cursor is None:
+            return ids
+
+
+# Lines just under, at and over the 64 KiB read block, and several blocks long.
+SIZES = [10, 65400, 65536, 65537, 3, 200000, 70000, 1, 131072, 50, 65300, 20]
+
+
+def test_pages_match_a_full_scan(shared, storage):
+    events = make_events(SIZES)
+    storage.append_events(events[:5])
+    storage.append_events(events[5:])
+
+    newest_first = [event["event_id"] for event in reversed(events)]
+    for limit in (1, 2, 5, 50):
+        assert read_pages(shared, limit) == newest_first
+        assert read_pages(shared, limit, user_id="a") == [
+            event["event_id"] for event in reversed(events) if event["user_id"] == "a"]
+        assert read_pages(shared, limit, button="BTN2", since="2024-01-01T00:00:03") == [
+            event["event_id"] for event in reversed(events)
+            if event["button"] == "BTN2" and event["timestamp"] >= "2024-01-01T00:00:03"]
+
+
+def test_partial_trailing_line_is_skipped(shared, storage):
+    if not isinstance(storage, shared.JsonStorage):
+        pytest.skip("the JSON event log only")
+    events = make_events([100, 70000, 100])
+    storage.append_events(events[:2])
+    # A concurrent writer has only got part of its line out.
+    tail = shared.json.dumps(events[2]) + "\n"
+    with open(shared.EVENTS_LOG_FILE, "a", encoding="utf-8") as f:
+        f.write(tail[:40])
+    assert read_pages(shared, 1) == ["e1", "e0"]
+    # Everything but the newline parses, yet the line is still not finished.
+    with open(shared.EVENTS_LOG_FILE, "a", encoding="utf-8") as f:
+        f.write(tail[40:-1])
+    assert read_pages(shared, 1) == ["e1", "e0"]
+
+    with open(shared.EVENTS_LOG_FILE, "a", encoding="utf-8") as f:
+        f.write("\n")
+    assert read_pages(shared, 1) == ["e2", "e1", "e0"]
+
+
+def test_cursor_survives_appends(shared, storage):
+    storage.append_events(make_events([10] * 6))
+    page, cursor = shared.query_events(limit=4)
+    assert [event["event_id"] for event in page] == ["e5", "e4", "e3", "e2"]
+
+    newer = make_events([10] * 8)[6:]
+    storage.append_events(newer)
+    page, cursor = shared.query_events(limit=4, cursor=cursor)
+    assert [event["event_id"] for event in page] == ["e1", "e0"]
+    assert cursor is None
+
+
+def test_reverse_reader_matches_forward_reader(shared, storage):
+    if not isinstance(storage, shared.JsonStorage):
+        pytest.skip("the JSON event log only")
+    for sizes in itertools.permutations([1, 65534, 65535, 65536], 3):
+        # The writer appends, so truncating under it starts a fresh log.
+        with open(shared.EVENTS_LOG_FILE, "w"):
+            pass
+        storage.append_events(make_events(sizes))
+        forward = [event["event_id"] for event in shared._iter_event_log()]
+        backward = [event["event_id"] for _, event in shared._iter_event_log_reverse()]
+        assert backward == forward[::-1]
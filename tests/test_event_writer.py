@@ -0,0 +1,34 @@
+import threading
+
+
+class GatedStorage:
+    """Storage whose writes wait until the gate opens."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.gate = threading.Event()
+
+    def append_events(self, events):
+        self.gate.wait(5)
+        self.inner.append_events(events)
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+
+def test_writer_survives_cancelled_waiter(shared, tmp_path):
+    storage = GatedStorage(shared.SqliteStorage(str(tmp_path / "events.db")))
+    shared.set_storage(storage)
+    writer = shared.EventWriter()
+
+    first = writer.submit([shared.build_event("BTN1", user_id="a")])
+    waiter = writer.submit([shared.build_event("BTN2", user_id="a")])
+    # Cancelling the awaiting request task cancels this future the same way.
+    assert waiter.cancel()
+    storage.gate.set()
+    first.result(timeout=5)
+
+    writer.write([shared.build_event("BTN3", user_id="a")])
+
+    assert [event["button"] for event in storage.inner.iter_events()] == ["BTN1", "BTN2", "BTN3"]
+    assert writer.stats()["events"] == 3